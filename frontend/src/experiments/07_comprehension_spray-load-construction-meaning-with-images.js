@@ -27,7 +27,7 @@ import "jspsych/plugins/jspsych-html-button-response";
 import "jspsych/plugins/jspsych-preload";
 import "../plugins/html-image-response-with-copout";
 
-import { get_trials } from "../materials";
+import { get_trials, get_image_bundle, supports_webp } from "../materials";
 import * as trials from "../trials";
 import { default_on_finish, default_on_data_update } from "../psiturk";
 
@@ -57,8 +57,11 @@ const image_trial_template = {
   shuffle: true,
   activate_delay: IMAGE_ACTIVATE_DELAY,
 };
+// Object URLs of images fetched in a single bundle, keyed by path
+let image_bundle = {};
 const make_full_image_path = (image_path) => {
-  return `images/${MATERIALS_HASH}/${image_path}`;
+  const bundle_path = `${MATERIALS_HASH}/${image_path.split("?")[0]}`;
+  return image_bundle[bundle_path] || `images/${MATERIALS_HASH}/${image_path}`;
 }
 
 // Helper function to add experiment ID to block spec
@@ -68,6 +71,16 @@ const a = (block) => trials.add_data_fields(block, { experiment_id: EXPERIMENT_N
 export async function createTimeline() {
   const trial_materials = await get_trials(EXPERIMENT_NAME, MATERIALS_SEQ);
 
+  // Fetch all images for critical trials in one request
+  const trial_images = _.uniq(_.flatten(
+    trial_materials.trials.map((trial) => _.values(trial.images || {}))));
+  // Images are displayed at most 350px wide, so fetch smaller variants, in
+  // WebP where the browser supports it and otherwise in the source format.
+  const variant = (await supports_webp()) ? { w: 640, format: "webp" } : { w: 640 };
+  image_bundle = await get_image_bundle(trial_images.map(
+    (image_path) => `${MATERIALS_HASH}/${image_path.split("?")[0]}`),
+    variant);
+
   let timeline = [];
 
   timeline.push(a(trials.age_block));
@@ -2,20 +2,148 @@
  * Specifies functions for retrieving and processing experimental materials.
  */
 
+// Maximum number of times to retry a request rejected by an overloaded server
+const MAX_RETRIES = 20;
+
 /**
  * @param experiment name of the experiment
  * @param materials_hash optional hashcode referring to the materials version to
  *                       be used. by default the latest materials are used.
  */
 export async function get_trials(experiment, materials_hash, extra_args = {}) {
-  const resp = await fetch(`/trials/${experiment}?` + new URLSearchParams({
+  const url = `/trials/${experiment}?` + new URLSearchParams({
     ...extra_args,
     uniqueId: window.uniqueId,
     materials: materials_hash
-  }));
-  const materials = await resp.json();
+  });
 
-  // TODO process?
+  // The server rejects requests with 503 when overloaded. Retry after the
+  // delay it asks for, with jitter so that retries don't arrive in lockstep.
+  let resp = await fetch(url);
+  for (let attempt = 0; resp.status == 503 && attempt < MAX_RETRIES; attempt++) {
+    const delay = parseFloat(resp.headers.get("Retry-After")) || 1;
+    await new Promise((resolve) =>
+      setTimeout(resolve, delay * 1000 * (1 + Math.random())));
+    resp = await fetch(url);
+  }
+  let materials = await resp.json();
+  if (materials.columns)
+    materials = from_columnar(materials);
 
   return materials;
 }
+
+/**
+ * Expand a trial list sent in the compact columnar format (requested with
+ * `extra_args = {format: "columnar"}`) into the usual list of trial objects.
+ */
+function from_columnar(materials) {
+  const { fields, columns, strings, interned, num_trials } = materials;
+  const is_interned = fields.map((_, i) => interned.includes(i));
+
+  const trials = [];
+  for (let t = 0; t < num_trials; t++) {
+    const trial = {};
+    fields.forEach((field, i) => {
+      let value = columns[i][t];
+      if (value !== null && is_interned[i])
+        value = strings[value];
+      trial[field] = value;
+    });
+    trials.push(trial);
+  }
+
+  return {
+    experiment: materials.experiment,
+    materials_id: materials.materials_id,
+    trials: trials,
+  };
+}
+
+// Smallest lossy WebP image
+const WEBP_TEST_IMAGE =
+  "data:image/webp;base64,UklGRiIAAABXRUJQVlA4IBYAAAAwAQCdASoBAAEADsD+JaQAA3AAAAAA";
+let webp_support = null;
+
+/**
+ * Check whether the browser can decode WebP images, e.g. to decide whether to
+ * request WebP image variants.
+ *
+ * @returns promise of a boolean
+ */
+export function supports_webp() {
+  if (webp_support === null) {
+    webp_support = new Promise((resolve) => {
+      const image = new Image();
+      image.onload = () => resolve(image.width > 0 && image.height > 0);
+      image.onerror = () => resolve(false);
+      image.src = WEBP_TEST_IMAGE;
+    });
+  }
+
+  return webp_support;
+}
+
+/**
+ * Fetch many images in a single request, rather than one request per image.
+ *
+ * @param image_paths paths of images relative to the images root, e.g.
+ *                    `${materials_hash}/${image_path}`
+ * @param variant optional resized / re-encoded variant of the images to
+ *                fetch, e.g. `{w: 640, format: "webp"}`. Only request WebP
+ *                if `supports_webp()`.
+ * @returns object mapping each bundled image path to an object URL for its
+ *          contents. Empty if the bundle could not be fetched, in which case
+ *          images should be requested individually.
+ */
+export async function get_image_bundle(image_paths, variant = {}) {
+  if (image_paths.length == 0) return {};
+
+  // Any failure to fetch or unpack the bundle falls back to requesting
+  // images individually, rather than keeping the experiment from starting.
+  let buffer;
+  try {
+    const resp = await fetch("/images/bundle", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ ...variant, images: image_paths }),
+    });
+    if (!resp.ok) return {};
+    buffer = await resp.arrayBuffer();
+  } catch (error) {
+    console.warn("could not fetch image bundle", error);
+    return {};
+  }
+
+  try {
+    return unpack_tar(buffer);
+  } catch (error) {
+    console.warn("could not unpack image bundle", error);
+    return {};
+  }
+}
+
+/**
+ * Unpack an (uncompressed USTAR) tar archive into object URLs keyed by path.
+ */
+function unpack_tar(buffer) {
+  const decoder = new TextDecoder();
+  const read_string = (offset, length) =>
+    decoder.decode(new Uint8Array(buffer, offset, length)).replace(/\0[^]*$/, "");
+
+  const urls = {};
+  let offset = 0;
+  while (offset + 512 <= buffer.byteLength) {
+    const name = read_string(offset, 100);
+    if (!name) break;
+
+    const prefix = read_string(offset + 345, 155);
+    const size = parseInt(read_string(offset + 124, 12), 8);
+    const data = new Uint8Array(buffer, offset + 512, size);
+    urls[prefix ? `${prefix}/${name}` : name] = URL.createObjectURL(new Blob([data]));
+
+    offset += 512 + Math.ceil(size / 512) * 512;
+  }
+
+  return urls;
+}
@@ -0,0 +1,177 @@
+"""
+Admission control for expensive routes, so that overload is answered with
+fast rejections rather than requests piling up until they time out.
+"""
+
+import threading
+import time
+
+
+def parse_request_start(header: str):
+    """
+    Parse an `X-Request-Start` header set by a reverse proxy (e.g.
+    `t=1628370478.823`) into a UNIX timestamp in seconds, or `None`.
+
+    Proxies variously report seconds, milliseconds or microseconds, which we
+    distinguish by magnitude.
+    """
+    if not header:
+        return None
+
+    try:
+        value = float(header[2:] if header.startswith("t=") else header)
+    except ValueError:
+        return None
+
+    for divisor in (1, 1e3, 1e6):
+        if value / divisor < 1e10:
+            return value / divisor
+    return None
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late a periodic timer fires. Under gevent, a request handler
+    which doesn't yield (e.g. while rendering) holds up the event loop, and
+    requests arriving meanwhile wait unseen in the accept queue, so the loop
+    lag is the time they have spent queued in this process.
+    """
+
+    def __init__(self, interval: float = 0.1, sleep=None):
+        """
+        Args:
+            interval: Seconds between timer ticks.
+            sleep: Function to sleep with, by default `time.sleep` (as
+                patched by gevent, if at all, when the monitor runs).
+        """
+        self.interval = interval
+        self._sleep = sleep
+
+        self._expected = None
+        self._last_lag = 0.0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True,
+                         name="loop-lag").start()
+        return self
+
+    def run(self):
+        while True:
+            self._expected = time.monotonic() + self.interval
+            (self._sleep or time.sleep)(self.interval)
+            self._last_lag = max(0.0, time.monotonic() - self._expected)
+
+    @property
+    def lag(self) -> float:
+        """
+        Seconds by which the last tick was late, or by which the current one
+        is already late if the loop is held up right now.
+        """
+        expected = self._expected
+        if expected is None:
+            return 0.0
+        return max(self._last_lag, time.monotonic() - expected)
+
+
+class AdmissionController(object):
+    """
+    Bounds the number of requests handled concurrently, and the number
+    waiting for a slot. Requests beyond these bounds, or which waited too
+    long for a slot, are rejected. So are requests arriving while the event
+    loop lags, which have already waited too long to be let through.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int,
+                 queue_timeout: float = 5.0, max_request_queue_time=None,
+                 max_loop_lag=None, loop_lag=None):
+        """
+        Args:
+            max_concurrent: Maximum number of admitted requests at once.
+            max_queued: Maximum number of requests waiting for admission.
+                Requests arriving when the queue is full are rejected
+                immediately.
+            queue_timeout: Maximum seconds to wait for admission.
+            max_request_queue_time: Optional maximum seconds a request may
+                have spent queued in front of the server, according to its
+                `X-Request-Start` header. Older requests are rejected
+                immediately, since their client has likely given up.
+            max_loop_lag: Optional maximum seconds of event loop lag, beyond
+                which requests are rejected immediately.
+            loop_lag: `LoopLagMonitor` measuring the lag, by default one
+                started with `start`.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.max_request_queue_time = max_request_queue_time
+        self.max_loop_lag = max_loop_lag
+        self.loop_lag = loop_lag
+        if max_loop_lag is not None and loop_lag is None:
+            self.loop_lag = LoopLagMonitor()
+
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def start(self):
+        """
+        Start measuring event loop lag, if requests are rejected on it.
+        """
+        if self.max_loop_lag is not None:
+            self.loop_lag.start()
+        return self
+
+    def acquire(self, request_start=None) -> bool:
+        """
+        Wait for admission. Returns `False` if the request is rejected, and
+        otherwise must be followed by `release`.
+
+        Args:
+            request_start: Optional UNIX timestamp at which the request
+                arrived at a reverse proxy.
+        """
+        with self._lock:
+            if self.queued >= self.max_queued or (
+                    self.max_request_queue_time is not None
+                    and request_start is not None
+                    and time.time() - request_start > self.max_request_queue_time) or (
+                    self.max_loop_lag is not None
+                    and self.loop_lag.lag > self.max_loop_lag):
+                self.rejected += 1
+                return False
+            self.queued += 1
+
+        admitted = self._slots.acquire(timeout=self.queue_timeout)
+
+        with self._lock:
+            self.queued -= 1
+            if admitted:
+                self.active += 1
+                self.admitted += 1
+            else:
+                self.rejected += 1
+
+        return admitted
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "active": self.active,
+                "queued": self.queued,
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+        if self.loop_lag is not None:
+            stats["loop_lag_seconds"] = self.loop_lag.lag
+        return stats
@@ -1,17 +1,36 @@
 import functools
+import gc
 import json
+import os
 from pathlib import Path
 import random
 import re
+import threading
+import time
 
 import logging
 
-from flask import Blueprint, jsonify, send_from_directory, request
+from flask import Blueprint, Response, jsonify, make_response, send_file, \
+    send_from_directory, request
 
+from psiturk.models import Participant
 from psiturk.psiturk_config import PsiturkConfig
 from psiturk.user_utils import PsiTurkAuthorization
 
-from renderers import TRIAL_RENDERERS
+from admission import AdmissionController, parse_request_start
+from images import DerivativeCache, ImageManifest, get_trial_images, \
+    iter_tar_bundle
+from live_stats import COMPLETED_STATUSES, LiveStats
+from materials_cache import MaterialsCache, MaterialsWatcher, is_content_id
+from metrics import MetricsRegistry, StageTimer, stage
+from prerender import PrerenderedTrialPool
+from renderers import TRIAL_RENDERERS, TrialRenderer, render_trials, \
+    render_trial_lists
+from response_cache import ResponseCache
+import serialization
+from trial_store import TrialListStore
+from warmup import warm_up
+from worker_index import WorkerIndex
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -20,55 +39,689 @@ L = logging.getLogger(__name__)
 
 config = PsiturkConfig()
 config.load_config()
-# myauth = PsiTurkAuthorization(config) # if you want to add a password protected route use this
+# Password protection of routes which expose study data, with the dashboard's
+# login_username, login_pw and secret_key from config.txt (or the
+# PSITURK_LOGIN_USERNAME, PSITURK_LOGIN_PW and PSITURK_SECRET_KEY environment
+# variables). Protected routes are disabled unless all are set.
+AUTH_SETTINGS = ("login_username", "login_pw", "secret_key")
+myauth = None
+if all(config.get("Server Parameters", key, fallback=None) for key in AUTH_SETTINGS):
+    myauth = PsiTurkAuthorization(config)
 
 # explore the Blueprint
 custom_code = Blueprint("custom_code", __name__, template_folder="templates", static_folder="static")
 
 
-###############
-# custom routes
+# Frontend bundles of the experiments hosted by this server, built into
+# `static/experiments/<experiment>/`. Participants are routed to an experiment
+# by the `experiment` parameter of the ad URL, which the ad and consent pages
+# pass on to /exp. Participants without one get DEFAULT_EXPERIMENT (the
+# EXPERIMENT build argument).
+#
+# HITs created with `psiturk hit create` all use the plain ad URL, and so run
+# DEFAULT_EXPERIMENT. To run a HIT of another hosted experiment, create it
+# with an ExternalQuestion URL of `<ad URL>?experiment=<experiment>` (MTurk
+# appends the assignment parameters), or deploy a server whose EXPERIMENT is
+# that experiment.
+EXPERIMENT_BUNDLES_ROOT = Path(custom_code.root_path) / "static" / "experiments"
+EXPERIMENT_BUNDLES = sorted(path.name for path in EXPERIMENT_BUNDLES_ROOT.iterdir()
+                            if path.is_dir()) \
+    if EXPERIMENT_BUNDLES_ROOT.is_dir() else []
+DEFAULT_EXPERIMENT = os.environ.get("DEFAULT_EXPERIMENT")
+if DEFAULT_EXPERIMENT not in EXPERIMENT_BUNDLES:
+    DEFAULT_EXPERIMENT = None
 
 
-@custom_code.route("/trials/<string:experiment>")
-def get_trials_for_experiment(experiment: str):
+# Request metrics, exported at /metrics
+metrics = MetricsRegistry()
+metrics.describe("custom_requests_total", "Requests to custom routes")
+metrics.describe("custom_request_seconds", "Latency of custom routes")
+metrics.describe("custom_stage_seconds",
+                 "Time spent in each stage of a request, inclusive of nested stages")
+
+# Parsed materials shared across requests
+materials_cache = MaterialsCache(
+    "/materials",
+    max_bytes=int(os.environ.get("MATERIALS_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    check_interval=float(os.environ.get("MATERIALS_CACHE_CHECK_INTERVAL", 1.0)))
+
+# Reload changed materials in the background rather than checking files on
+# each request. Set MATERIALS_WATCH=0 to disable.
+materials_watcher = None
+if os.environ.get("MATERIALS_WATCH", "1") != "0":
+    materials_watcher = MaterialsWatcher(materials_cache)
+
+# Content hashes of materials images, used to version image URLs
+IMAGES_ROOT = os.environ.get("IMAGES_ROOT", "/materials/images")
+image_manifest = ImageManifest(IMAGES_ROOT).scan()
+TrialRenderer.image_manifest = image_manifest
+
+# Resized and re-encoded variants of images, requested with the `w` and
+# `format` parameters
+image_derivatives = DerivativeCache(
+    image_manifest,
+    os.environ.get("IMAGE_DERIVATIVES_ROOT", "/data/image_derivatives"),
+    widths=[int(width) for width in
+            os.environ.get("IMAGE_DERIVATIVE_WIDTHS", "320,640,1024").split(",")])
+
+# Maximum number of images sent in a single bundle
+IMAGES_BUNDLE_MAX = int(os.environ.get("IMAGES_BUNDLE_MAX", 500))
+
+# Optionally keep ready-made trial lists in a background queue
+prerendered_trials = None
+if int(os.environ.get("TRIALS_PRERENDER_SIZE", 0)) > 0:
+    prerendered_trials = PrerenderedTrialPool(
+        materials_cache.get, size=int(os.environ["TRIALS_PRERENDER_SIZE"]))
+
+# Serialized responses for seeded renders
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get("TRIALS_RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024)))
+
+# If set, seed renders with the participant's `uniqueId` unless an explicit
+# `seed` is requested, so that each participant's list is reproducible.
+TRIALS_SEED_FROM_UNIQUEID = bool(os.environ.get("TRIALS_SEED_FROM_UNIQUEID"))
+
+# Persist the first trial list served to each participant, so that reloading
+# the experiment doesn't re-randomize it. Set TRIALS_STORE_PATH to an empty
+# string to disable.
+trial_store = None
+if os.environ.get("TRIALS_STORE_PATH", "/data/trial_lists.db"):
+    trial_store = TrialListStore(
+        os.environ.get("TRIALS_STORE_PATH", "/data/trial_lists.db"))
+
+# Bound concurrency of the trial routes in each worker process, rejecting
+# excess requests with a fast 503 rather than letting them queue until they
+# time out. NB the psiturk `threads` setting is the number of gunicorn worker
+# processes, each of which serves many concurrent requests on gevent, so
+# limits are set per process with ADMISSION_MAX_CONCURRENT (requests rendering
+# at once) and ADMISSION_MAX_QUEUED (requests waiting up to
+# ADMISSION_QUEUE_TIMEOUT seconds for a slot). Images are not admission
+# controlled, since browsers preload them in parallel and never retry.
+#
+# Renders don't yield to gevent, so requests arriving during one wait in the
+# accept queue rather than for a slot. Requests are therefore also rejected
+# while the event loop lags by more than ADMISSION_MAX_LOOP_LAG seconds (set to
+# an empty string to disable), and optionally when a reverse proxy's
+# X-Request-Start header shows they queued in front of the server for more
+# than ADMISSION_MAX_REQUEST_QUEUE_TIME seconds.
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", 50)),
+    max_queued=int(os.environ.get("ADMISSION_MAX_QUEUED", 200)),
+    queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 5.0)),
+    max_request_queue_time=float(os.environ["ADMISSION_MAX_REQUEST_QUEUE_TIME"])
+    if os.environ.get("ADMISSION_MAX_REQUEST_QUEUE_TIME") else None,
+    max_loop_lag=float(os.environ.get("ADMISSION_MAX_LOOP_LAG", 1.0))
+    if os.environ.get("ADMISSION_MAX_LOOP_LAG", "1.0") else None)
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 2))
+
+# Running statistics of completed participants in each psiturk mode, served
+# at /stats
+def fetch_completed_participants(mode, since):
+    query = Participant.query \
+        .filter(Participant.mode == mode,
+                Participant.status.in_(COMPLETED_STATUSES),
+                Participant.endhit.isnot(None))
+    if since is not None:
+        query = query.filter(Participant.endhit >= since)
+
+    return query.with_entities(Participant.uniqueid, Participant.endhit,
+                               Participant.datastring).yield_per(100)
+
+
+live_stats = {mode: LiveStats(functools.partial(fetch_completed_participants, mode))
+              for mode in ("live", "sandbox", "debug")}
+
+# Index of workers who took part in any of our experiments, for screening
+# repeat participants. WORKER_INDEX_SOURCES is a comma-separated list of
+# `name=path` pairs naming each experiment's sqlite participant database. By
+# default, just this server's own database is indexed. The index is updated
+# in the background every WORKER_INDEX_UPDATE_INTERVAL seconds.
+worker_index_sources = {}
+if os.environ.get("WORKER_INDEX_SOURCES"):
+    worker_index_sources = dict(source.split("=", 1) for source
+                                in os.environ["WORKER_INDEX_SOURCES"].split(","))
+elif config.get("Database Parameters", "database_url").startswith("sqlite:///"):
+    worker_index_sources = {
+        DEFAULT_EXPERIMENT or "default":
+            config.get("Database Parameters", "database_url")[len("sqlite:///"):]}
+worker_index = WorkerIndex(
+    worker_index_sources,
+    os.environ.get("WORKER_INDEX_PATH", "/data/worker_index.db"),
+    table_name=config.get("Database Parameters", "table_name"),
+    update_interval=float(os.environ.get("WORKER_INDEX_UPDATE_INTERVAL", 10)))
+
+# Response formats of trial lists, selected with the `format` parameter.
+# "columnar" names each field once, interns repeated strings, and only
+# includes fields read by the experiment's frontend.
+TRIALS_FORMATS = ("json", "columnar")
+
+# Maximum number of trial lists rendered by a single batch request. Batches
+# tie up a worker process for their whole render, so keep this small.
+TRIALS_BATCH_MAX = int(os.environ.get("TRIALS_BATCH_MAX", 50))
+
+# Pay lazy startup costs before serving the first participant. Set WARMUP=0
+# to disable, or WARMUP_EXPERIMENTS to a comma-separated list of experiments
+# (by default, all hosted experiments, or else all registered experiments).
+# Materials and compiled renderer state are shared by all experiments which
+# use them.
+if os.environ.get("WARMUP", "1") != "0":
+    warm_up(materials_cache.get,
+            experiments=os.environ["WARMUP_EXPERIMENTS"].split(",")
+            if os.environ.get("WARMUP_EXPERIMENTS") else EXPERIMENT_BUNDLES or None)
+
+
+# PID of the process whose resources have been started
+_resources_pid = None
+_resources_lock = threading.Lock()
+
+
+def start_process_resources():
+    """
+    Start the background threads and open the connections used by this
+    process, unless they have already been started. None of these survive a
+    fork.
+    """
+    global _resources_pid
+    with _resources_lock:
+        if _resources_pid == os.getpid():
+            return
+        _resources_pid = os.getpid()
+
+    if materials_watcher is not None:
+        materials_watcher.start()
+    if prerendered_trials is not None:
+        prerendered_trials.start()
+    if trial_store is not None:
+        trial_store.start()
+    worker_index.start()
+    admission.start()
+
+
+def reinit_after_fork():
+    # Connections to the participant database opened by the master must not
+    # be shared with workers.
+    try:
+        from psiturk.db import engine
+    except ImportError:
+        pass
+    else:
+        engine.dispose()
+
+    start_process_resources()
+
+
+# Set PRELOAD=1 when the app is loaded once in a master process which then
+# forks workers (e.g. `gunicorn --preload`). The materials and renderer state
+# loaded above are then shared copy-on-write by all workers, and per-process
+# resources are only started in the workers: right after the fork, or else
+# (if the app was in fact loaded in the worker, as `psiturk-server` does) on
+# the first request.
+if os.environ.get("PRELOAD") == "1":
+    # Keep the garbage collector from writing to (and thus copying) pages of
+    # preloaded objects in workers.
+    gc.freeze()
+    os.register_at_fork(after_in_child=reinit_after_fork)
+
+    @custom_code.before_app_request
+    def ensure_process_resources():
+        start_process_resources()
+else:
+    start_process_resources()
+
+
+def instrumented(route: str):
+    """
+    Decorator recording request counts, latencies and stage timings of a
+    view under the given route name.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            labels = (("route", route),)
+            if "experiment" in kwargs:
+                # NB don't allow clients to create arbitrary label values
+                experiment = kwargs["experiment"]
+                labels += (("experiment", experiment if experiment in TRIAL_RENDERERS
+                            else "unknown"),)
+
+            # NB unhandled errors are counted as the 500s they turn into
+            status = 500
+            start = time.perf_counter()
+            try:
+                with StageTimer() as timer:
+                    response = make_response(view(**kwargs))
+                status = response.status_code
+            finally:
+                elapsed = time.perf_counter() - start
+
+                metrics.inc("custom_requests_total",
+                            labels + (("status", status),))
+                metrics.observe("custom_request_seconds", elapsed, labels)
+                for stage_name, total in timer.totals.items():
+                    metrics.observe("custom_stage_seconds", total,
+                                    labels + (("stage", stage_name),))
+
+            return response
+        return wrapper
+    return decorator
+
+
+def admitted(view):
+    """
+    Decorator subjecting a view to admission control.
+    """
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        request_start = parse_request_start(request.headers.get("X-Request-Start"))
+        if not admission.acquire(request_start):
+            return 'server is busy, please retry', 503, \
+                {"Retry-After": str(ADMISSION_RETRY_AFTER)}
+
+        try:
+            return view(**kwargs)
+        finally:
+            admission.release()
+    return wrapper
+
+
+def requires_auth(view):
+    """
+    Decorator protecting a view with psiturk's basic auth. Views respond
+    with 404 if no credentials are configured.
+    """
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        if myauth is None:
+            return 'not found', 404
+        return myauth.requires_auth(view)(**kwargs)
+    return wrapper
+
+
+def load_request_materials():
+    """
+    Load the materials named by the `materials` parameter of the current
+    request.
+
+    Returns:
+        Tuple `(materials_id, materials)`
+
+    Raises:
+        ValueError: with args `(message, http_status)`
+    """
     # Get unique materials ID
     try:
         materials_id = request.args["materials"].split(",")
     except KeyError:
         # TODO use latest materials by default
-        return 'missing materials parameter', 400
+        raise ValueError('missing materials parameter', 400)
+
+    with stage("materials"):
+        materials = tuple([materials_cache.get(id) for id in materials_id])
+    return materials_id, materials
+
+
+def serialize_trials(trials, response_format: str, renderer_cls):
+    """
+    Serialize a rendered trial list in one of `TRIALS_FORMATS`.
+    """
+    if response_format == "columnar":
+        trials = serialization.to_columnar(trials, renderer_cls.frontend_fields)
+    return serialization.dumps(trials)
+
+
+def get_image_variant(args):
+    """
+    Get the requested `(width, format)` of an image variant, either of which
+    may be `None` for the source image's.
+
+    Raises:
+        ValueError: with args `(message, http_status)`
+    """
+    width = args.get("w")
+    if width is not None:
+        try:
+            width = int(width)
+        except (TypeError, ValueError):
+            raise ValueError('w must be an integer', 400)
+
+    image_format = args.get("format")
+    if image_format is not None and not isinstance(image_format, str):
+        raise ValueError('format must be a string', 400)
+
+    return width, image_format
+
+
+def json_response(body: bytes, cached=None):
+    """
+    Build a response from a serialized JSON body, compressed in the
+    client's preferred content encoding.
+
+    Args:
+        body: Serialized JSON.
+        cached: Optional `CachedResponse` holding `body`. If given, compressed
+            bodies are cached along with it, and conditional requests are
+            answered based on its ETag.
+    """
+    encoding = serialization.choose_content_encoding(
+        request.accept_encodings, len(body))
+    if encoding is not None:
+        with stage("compress"):
+            body = response_cache.encode(cached, encoding) if cached is not None \
+                else serialization.compress(body, encoding)
+
+    response = Response(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.content_encoding = encoding
 
-    def load_materials(materials_id):
-        if ".." in materials_id:
-            raise ValueError('STOP, injection attack detected', 400)
+    if cached is not None:
+        # Each content encoding is a distinct representation
+        response.set_etag(cached.etag if encoding is None
+                          else f"{cached.etag}-{encoding}")
+        response = response.make_conditional(request)
 
-        # Try loading.
-        materials_path = Path("/materials") / (f"{materials_id}.json")
-        if not materials_path.exists():
-            raise ValueError(f'could not find materials with id {materials_id}', 404)
+    return response
 
-        with materials_path.open() as f:
-            materials = json.load(f)
 
-        return materials
+@custom_code.app_context_processor
+def inject_experiment():
+    """
+    Make the experiment requested by the participant available to all
+    templates, so that /exp loads that experiment's frontend bundle.
+    """
+    experiment = request.args.get("experiment")
+    if experiment not in EXPERIMENT_BUNDLES:
+        experiment = DEFAULT_EXPERIMENT
+    return {"experiment": experiment}
 
+
+###############
+# custom routes
+
+
+@custom_code.route("/trials/<string:experiment>")
+@instrumented("trials")
+@admitted
+def get_trials_for_experiment(experiment: str):
     try:
-        materials = tuple([load_materials(id) for id in materials_id])
+        materials_id, materials = load_request_materials()
     except ValueError as exc:
         return exc.args
 
     # render trials from materials
     try:
-        renderer = TRIAL_RENDERERS[experiment](experiment)
+        renderer_cls = TRIAL_RENDERERS[experiment]
     except KeyError:
         return f'cannot find trial renderer for experiment {experiment}', 500
 
-    trials = renderer.get_trials(materials, materials_id, args=request.args)
+    response_format = request.args.get("format", "json")
+    if response_format not in TRIALS_FORMATS:
+        return f'unknown format {response_format}', 400
+
+    seed = request.args.get("seed")
+    unique_id = request.args.get("uniqueId")
+
+    # Participants get back the list they were first served, unless a
+    # specific seed is requested.
+    store_participant = trial_store is not None and unique_id and seed is None
+    if store_participant:
+        with stage("trial_store"):
+            body = trial_store.get(unique_id, experiment, materials_id)
+        if body is not None:
+            if response_format != "json":
+                with stage("serialize"):
+                    body = serialize_trials(json.loads(body), response_format,
+                                            renderer_cls)
+            return json_response(body)
+
+    if seed is None and TRIALS_SEED_FROM_UNIQUEID:
+        seed = unique_id
+
+    if seed is None:
+        trials = None
+        if prerendered_trials is not None:
+            trials = prerendered_trials.pop(experiment, materials_id, materials)
+        if trials is None:
+            with stage("renderer"):
+                renderer = renderer_cls(experiment)
+            with stage("render"):
+                trials = renderer.get_trials(materials, materials_id,
+                                             args=request.args)
+
+        if store_participant:
+            # The store keeps full trial lists, whatever the response format.
+            with stage("serialize"):
+                body = serialization.dumps(trials)
+            stored = trial_store.put(unique_id, experiment, materials_id, body)
+            if stored is not body:
+                # A concurrent request stored its list first.
+                body, trials = stored, json.loads(stored)
+            if response_format == "json":
+                return json_response(body)
+
+        with stage("serialize"):
+            body = serialize_trials(trials, response_format, renderer_cls)
+        return json_response(body)
+
+    # Seeded renders are deterministic, so we can cache the serialized
+    # response and answer conditional requests.
+    cache_key = (experiment, tuple(materials_id), seed, response_format)
+    cached = response_cache.get(cache_key, materials)
+    if cached is None:
+        with stage("render"):
+            trials = render_trials(experiment, materials, materials_id,
+                                   seed=seed, args=request.args)
+        with stage("serialize"):
+            cached = response_cache.put(
+                cache_key, materials,
+                serialize_trials(trials, response_format, renderer_cls))
+
+    # NB seeded lists in other formats needn't be stored, since they can
+    # always be reproduced from their seed.
+    if store_participant and response_format == "json":
+        body = trial_store.put(unique_id, experiment, materials_id, cached.body)
+        if body is not cached.body:
+            return json_response(body)
+
+    response = json_response(cached.body, cached=cached)
+    if all(is_content_id(id) for id in materials_id):
+        # Seeded renders of content-addressed materials never change.
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@custom_code.route("/trials/<string:experiment>/batch")
+@instrumented("trials_batch")
+@requires_auth
+@admitted
+def get_trials_batch_for_experiment(experiment: str):
+    """
+    Render many independent trial lists at once, e.g. to check the balance
+    of conditions over participants. Requires authorization.
+    """
+    try:
+        n = int(request.args.get("n", 1))
+    except ValueError:
+        return 'n must be an integer', 400
+    if not 0 < n <= TRIALS_BATCH_MAX:
+        return f'n must be between 1 and {TRIALS_BATCH_MAX}', 400
+
+    try:
+        materials_id, materials = load_request_materials()
+    except ValueError as exc:
+        return exc.args
+
+    if experiment not in TRIAL_RENDERERS:
+        return f'cannot find trial renderer for experiment {experiment}', 500
+
+    with stage("render"):
+        trial_lists = []
+        for _ in range(n):
+            trial_lists.extend(render_trial_lists(
+                experiment, materials, materials_id, 1, args=request.args))
+
+            # Let other requests of this (gevent) worker run between renders
+            time.sleep(0)
 
-    return jsonify(trials)
+    with stage("serialize"):
+        body = serialization.dumps(dict(
+            experiment=experiment, materials_id=materials_id,
+            trial_lists=trial_lists))
+    return json_response(body)
 
 
 @custom_code.route("/images/<path:path>")
+@instrumented("images")
 def get_image(path: Path):
-    return send_from_directory("/materials/images", path)
+    info = image_manifest.get(path)
+    if info is None:
+        return send_from_directory(IMAGES_ROOT, path)
+
+    try:
+        width, image_format = get_image_variant(request.args)
+    except ValueError as exc:
+        return exc.args
+
+    # Files are sent with `wsgi.file_wrapper` (i.e. sendfile under gunicorn),
+    # and conditional and range requests are answered by our content hash.
+    if width is None and image_format is None:
+        response = send_from_directory(IMAGES_ROOT, path, add_etags=False,
+                                       conditional=True)
+        response.set_etag(info.hash)
+        response = response.make_conditional(request)
+    else:
+        try:
+            with stage("derivative"):
+                derivative_path = image_derivatives.get(path, width, image_format)
+        except ValueError as exc:
+            return exc.args
+
+        response = send_file(str(derivative_path), add_etags=False,
+                             conditional=True)
+        response.set_etag(f"{info.hash}-{derivative_path.name}")
+        response = response.make_conditional(request)
+
+    if request.args.get("v") == info.hash:
+        # Content-versioned URLs never change.
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+
+    return response
+
+
+@custom_code.route("/images/bundle", methods=["POST"])
+@instrumented("images_bundle")
+def get_image_bundle():
+    """
+    Stream a tar archive of many images in one response. The request body is
+    JSON, containing either a list of `images` (paths relative to the images
+    root) or a rendered trial list with `trials`, and optionally a `w` and
+    `format` of the image variants to bundle.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return 'expected a JSON object', 400
+
+    if "images" in data:
+        images = data["images"]
+        if not isinstance(images, list) \
+                or not all(isinstance(path, str) for path in images):
+            return 'images must be a list of strings', 400
+        paths = [path.split("?", 1)[0] for path in images]
+    elif "trials" in data:
+        trials = data["trials"]
+        if not isinstance(trials, list) \
+                or not all(isinstance(trial, dict) for trial in trials):
+            return 'trials must be a list of objects', 400
+        try:
+            paths = get_trial_images(trials)
+        except ValueError as exc:
+            return exc.args
+    else:
+        return 'missing images or trials', 400
+
+    if len(paths) > IMAGES_BUNDLE_MAX:
+        return f'cannot bundle more than {IMAGES_BUNDLE_MAX} images', 400
+
+    # Only known images can be bundled, which also rules out path traversal.
+    missing = [path for path in paths if image_manifest.get(path) is None]
+    if missing:
+        return f'could not find images {", ".join(missing)}', 404
+
+    # Optionally bundle a variant of each image, as for single images
+    try:
+        width, image_format = get_image_variant(data)
+        resolve = None
+        if width is not None or image_format is not None:
+            with stage("derivative"):
+                derivatives = {path: image_derivatives.get(path, width, image_format)
+                               for path in paths}
+            resolve = derivatives.__getitem__
+    except ValueError as exc:
+        return exc.args
+
+    return Response(iter_tar_bundle(Path(IMAGES_ROOT), paths, resolve=resolve),
+                    mimetype="application/x-tar")
+
+
+@custom_code.route("/stats")
+@instrumented("stats")
+@requires_auth
+def get_stats():
+    """
+    Completions, slider response statistics, filler accuracy and median
+    response times per experiment and condition, over all participants who
+    completed the study in the given `mode` (default `live`).
+    """
+    mode = request.args.get("mode", "live")
+    try:
+        stats = live_stats[mode]
+    except KeyError:
+        return f'mode must be one of {", ".join(live_stats)}', 400
+
+    # Only participants who completed since the last request are processed.
+    with stage("update"):
+        stats.update()
+    return jsonify(stats.summary())
+
+
+@custom_code.route("/workers/<string:worker_id>")
+@instrumented("workers")
+@requires_auth
+def get_worker_participations(worker_id: str):
+    """
+    Look up a worker's participations in any indexed experiment, e.g. to
+    screen out repeat participants when they accept a HIT. Requires
+    authorization, since participations identify MTurk workers.
+    """
+    # NB the index is updated in the background, so participants who
+    # started in the last few seconds may be missing.
+    participations = worker_index.lookup(worker_id)
+
+    return jsonify(worker_id=worker_id, repeat=bool(participations),
+                   participations=participations)
+
+
+@custom_code.route("/metrics")
+def get_metrics():
+    gauges = []
+    for cache_name, cache in [("materials_cache", materials_cache),
+                              ("response_cache", response_cache)]:
+        stats = cache.stats()
+        for key, value in stats.items():
+            gauges.append((f"{cache_name}_{key}", (), value))
+
+        lookups = stats["hits"] + stats["misses"]
+        gauges.append((f"{cache_name}_hit_ratio", (),
+                       stats["hits"] / lookups if lookups else 0))
+
+    for key, value in admission.stats().items():
+        gauges.append((f"admission_{key}", (), value))
+
+    if trial_store is not None:
+        for key, value in trial_store.stats().items():
+            gauges.append((f"trial_store_{key}", (), value))
+
+    return Response(metrics.render(gauges),
+                    mimetype="text/plain; version=0.0.4")
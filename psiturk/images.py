@@ -0,0 +1,266 @@
+"""
+Manifest of materials images, used to serve them under content-versioned
+URLs which can be cached indefinitely, and to bundle many images into one
+response.
+"""
+
+from collections import namedtuple
+import hashlib
+import logging
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+L = logging.getLogger(__name__)
+
+
+ImageInfo = namedtuple("ImageInfo", ["path", "hash", "size", "width", "height"])
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:16]
+
+
+def get_dimensions(path: Path):
+    """
+    Get `(width, height)` of an image, or `(None, None)` if unknown.
+    """
+    if Image is None:
+        return None, None
+
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except Exception:
+        L.warning("could not read image dimensions of %s", path)
+        return None, None
+
+
+class ImageManifest(object):
+    """
+    Content hashes, sizes and dimensions of all images under a root
+    directory, keyed by path relative to that root.
+    """
+
+    def __init__(self, root="/materials/images"):
+        self.root = Path(root)
+        self.images = {}
+
+    def scan(self):
+        images = {}
+        if self.root.is_dir():
+            for path in sorted(self.root.rglob("*")):
+                if not path.is_file():
+                    continue
+
+                rel_path = path.relative_to(self.root).as_posix()
+                width, height = get_dimensions(path)
+                images[rel_path] = ImageInfo(rel_path, hash_file(path),
+                                             path.stat().st_size, width, height)
+
+        self.images = images
+        L.info("indexed %i images under %s", len(images), self.root)
+        return self
+
+    def get(self, path: str):
+        return self.images.get(path)
+
+    def versioned_path(self, path: str, relative_to: str = None) -> str:
+        """
+        Add a content version to an image path, if the image is known.
+
+        Args:
+            path: Image path, relative to the manifest root by default.
+            relative_to: Optional subdirectory of the manifest root which
+                `path` is relative to (e.g. a materials ID).
+        """
+        full_path = f"{relative_to}/{path}" if relative_to else path
+        info = self.images.get(full_path)
+        if info is None:
+            return path
+
+        return f"{path}?v={info.hash}"
+
+
+# Formats of image derivatives: name -> (Pillow format, file extension)
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "webp"),
+    "jpeg": ("JPEG", "jpg"),
+    "png": ("PNG", "png"),
+}
+
+
+class DerivativeCache(object):
+    """
+    Resized and/or re-encoded variants of manifest images, generated with
+    Pillow on first request and kept on disk, keyed by source content hash.
+    """
+
+    def __init__(self, manifest: ImageManifest, root="/data/image_derivatives",
+                 widths=(320, 640, 1024), quality=80):
+        """
+        Args:
+            manifest: Manifest of source images.
+            root: Directory in which to store derivatives.
+            widths: Widths in pixels which may be requested. Images are never
+                scaled up.
+            quality: Encoder quality for lossy formats.
+        """
+        self.manifest = manifest
+        self.root = Path(root)
+        self.widths = tuple(widths)
+        self.quality = quality
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def path_for(self, info: ImageInfo, width=None, format=None) -> Path:
+        source_ext = Path(info.path).suffix.lstrip(".")
+        ext = DERIVATIVE_FORMATS[format][1] if format else source_ext
+        name = f"w{width}.{ext}" if width else f"full.{ext}"
+        return self.root / info.hash[:2] / info.hash / name
+
+    def get(self, path: str, width=None, format=None) -> Path:
+        """
+        Get the path of a derivative of the given image, generating it if
+        necessary.
+
+        Raises:
+            ValueError: with args `(message, http_status)` for unknown images
+                or unsupported variants.
+        """
+        info = self.manifest.get(path)
+        if info is None:
+            raise ValueError(f'could not find image {path}', 404)
+        if width is not None and width not in self.widths:
+            raise ValueError(f'width must be one of {", ".join(map(str, self.widths))}', 400)
+        if format is not None and format not in DERIVATIVE_FORMATS:
+            raise ValueError(f'format must be one of {", ".join(DERIVATIVE_FORMATS)}', 400)
+        if not self.available:
+            raise ValueError('image derivatives are not available', 501)
+
+        derivative_path = self.path_for(info, width, format)
+        if not derivative_path.exists():
+            self.generate(info, width, format)
+        return derivative_path
+
+    def generate(self, info: ImageInfo, width=None, format=None):
+        source_path = self.manifest.root / info.path
+        derivative_path = self.path_for(info, width, format)
+        derivative_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with Image.open(source_path) as image:
+            pil_format = DERIVATIVE_FORMATS[format][0] if format else image.format
+            if width is not None and image.width > width:
+                image = image.resize(
+                    (width, max(1, round(image.height * width / image.width))),
+                    Image.LANCZOS)
+            if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            # Write atomically, so that concurrent requests never see a
+            # partial file.
+            fd, tmp_path = tempfile.mkstemp(dir=derivative_path.parent,
+                                            suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    image.save(f, format=pil_format, quality=self.quality)
+                os.replace(tmp_path, derivative_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        L.debug("generated image derivative %s", derivative_path)
+
+    def generate_all(self, formats=(None,)):
+        """
+        Generate all derivatives of all manifest images in the given formats
+        (where `None` keeps the source format) which don't exist yet.
+
+        Returns:
+            Number of generated derivatives.
+        """
+        num_generated = 0
+        for info in self.manifest.images.values():
+            for format in formats:
+                for width in self.widths:
+                    if not self.path_for(info, width, format).exists():
+                        self.generate(info, width, format)
+                        num_generated += 1
+
+        return num_generated
+
+
+def iter_tar_bundle(root: Path, paths, chunk_size=1 << 16, resolve=None):
+    """
+    Stream an uncompressed (USTAR) tar archive of the given image paths
+    relative to `root`, without buffering whole files in memory.
+
+    Args:
+        root: Directory which `paths` are relative to.
+        paths: Image paths, which are also their names in the archive.
+        chunk_size: Size in bytes of the chunks in which files are read.
+        resolve: Optional function mapping each path to the file to archive
+            under that path, e.g. an image derivative.
+    """
+    for path in paths:
+        full_path = resolve(path) if resolve is not None else root / path
+        stat = full_path.stat()
+
+        info = tarfile.TarInfo(path)
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.USTAR_FORMAT)
+
+        with full_path.open("rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+    # end-of-archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def get_trial_images(trials):
+    """
+    Collect the image paths (relative to the images root, without content
+    versions) referenced by a rendered trial list.
+
+    Raises:
+        ValueError: with args `(message, http_status)` if trials are malformed
+    """
+    paths = []
+    for trial in trials:
+        images = trial.get("images") or {}
+        if not isinstance(images, dict):
+            raise ValueError('trial images must be an object', 400)
+
+        for image in images.values():
+            if image is None:
+                continue
+            if not isinstance(image, str) \
+                    or not isinstance(trial.get("materials_id"), str):
+                raise ValueError('trial images and materials_id must be strings', 400)
+
+            path = f"{trial['materials_id']}/{image.split('?', 1)[0]}"
+            if path not in paths:
+                paths.append(path)
+
+    return paths
@@ -0,0 +1,210 @@
+"""
+Running statistics of an ongoing study, updated incrementally from newly
+completed participants rather than by re-extracting all participant data
+(as `src/data.py` does).
+"""
+
+from bisect import insort
+from collections import defaultdict
+import json
+import logging
+import math
+import threading
+
+
+L = logging.getLogger(__name__)
+
+
+# psiturk participant status codes of participants who finished the study
+# (COMPLETED, SUBMITTED, CREDITED, BONUSED)
+COMPLETED_STATUSES = (3, 4, 5, 7)
+
+# Slider midpoints separating "negative" from "positive" filler responses,
+# by expected filler rating. Responses at the midpoint count as incorrect.
+FILLER_SLIDER_MIDPOINTS = {
+    "good": 4, "bad": 4,       # acceptability, 1-7
+    "full": 50, "empty": 50,   # comprehension, 0-100
+}
+POSITIVE_FILLER_RATINGS = {"good", "full"}
+
+
+class RunningStats(object):
+    """
+    Count, mean and variance of a stream of values (Welford's algorithm).
+    """
+
+    __slots__ = ("n", "mean", "_m2")
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self._m2 / (self.n - 1) if self.n > 1 else math.nan
+
+
+class ConditionStats(object):
+
+    def __init__(self):
+        self.num_trials = 0
+        self.slider = RunningStats()
+        self.num_copouts = 0
+        self.filler_correct = 0
+        self.filler_total = 0
+
+        # NB kept sorted, for medians
+        self.rts = []
+
+    def add_trial(self, trialdata, condition_id):
+        self.num_trials += 1
+        if trialdata.get("rt") is not None:
+            insort(self.rts, trialdata["rt"])
+
+        response = trialdata.get("response")
+        if trialdata.get("copout"):
+            self.num_copouts += 1
+        elif isinstance(response, (int, float)) and not isinstance(response, bool):
+            self.slider.add(response)
+
+        correct = _is_filler_correct(condition_id, response)
+        if correct is not None:
+            self.filler_total += 1
+            self.filler_correct += correct
+
+    def as_dict(self):
+        ret = {
+            "num_trials": self.num_trials,
+            "median_rt": _median(self.rts),
+        }
+        if self.slider.n or self.num_copouts:
+            ret.update(slider_n=self.slider.n,
+                       slider_mean=self.slider.mean if self.slider.n else None,
+                       slider_variance=_finite(self.slider.variance),
+                       num_copouts=self.num_copouts)
+        if self.filler_total:
+            ret["filler_accuracy"] = self.filler_correct / self.filler_total
+
+        return ret
+
+
+def _is_filler_correct(condition_id, response):
+    """
+    Whether a response to a filler trial was correct, or `None` if this is
+    not a filler trial with a known correct response.
+    """
+    if len(condition_id) != 2 or condition_id[0] != "filler":
+        return None
+    rating = condition_id[1]
+
+    if isinstance(response, dict):
+        # Forced choice between a good and a bad sentence
+        choice = next(iter(response.values()), None)
+        return choice == "good" if choice in ("good", "bad") else None
+
+    if isinstance(response, (int, float)) and rating in FILLER_SLIDER_MIDPOINTS:
+        midpoint = FILLER_SLIDER_MIDPOINTS[rating]
+        if rating in POSITIVE_FILLER_RATINGS:
+            return response > midpoint
+        return response < midpoint
+
+    return None
+
+
+def _median(sorted_values):
+    if not sorted_values:
+        return None
+
+    mid = len(sorted_values) // 2
+    if len(sorted_values) % 2:
+        return sorted_values[mid]
+    return (sorted_values[mid - 1] + sorted_values[mid]) / 2
+
+
+def _finite(value):
+    return None if math.isnan(value) else value
+
+
+class LiveStats(object):
+    """
+    Aggregates per experiment and condition over all completed participants,
+    updated incrementally.
+    """
+
+    def __init__(self, fetch_completed):
+        """
+        Args:
+            fetch_completed: Function `f(since)` returning `(uniqueid, endhit,
+                datastring)` rows of participants who completed the study at
+                or after `since` (all participants if `since` is `None`).
+        """
+        self.fetch_completed = fetch_completed
+
+        self._lock = threading.Lock()
+        self._since = None
+        self._seen = set()
+
+        self.completions = defaultdict(int)
+        self.conditions = defaultdict(lambda: defaultdict(ConditionStats))
+
+    def update(self):
+        """
+        Add participants who completed since the last update.
+
+        Returns:
+            Number of newly added participants.
+        """
+        with self._lock:
+            num_added = 0
+            for uniqueid, endhit, datastring in self.fetch_completed(self._since):
+                if self._since is None or endhit > self._since:
+                    self._since = endhit
+
+                # NB rows completed at the previous watermark are fetched again
+                if uniqueid in self._seen:
+                    continue
+                self._seen.add(uniqueid)
+
+                try:
+                    self._add_participant(json.loads(datastring))
+                except (TypeError, ValueError, KeyError):
+                    L.warning("could not parse data of participant %s", uniqueid)
+                    continue
+                num_added += 1
+
+            return num_added
+
+    def _add_participant(self, data):
+        experiments = set()
+        for trial in data["data"]:
+            trialdata = trial["trialdata"]
+            experiment = trialdata.get("experiment_id")
+            condition_id = trialdata.get("condition_id")
+            if experiment is None or condition_id is None:
+                continue
+
+            experiments.add(experiment)
+            condition = "/".join(map(str, condition_id))
+            self.conditions[experiment][condition].add_trial(trialdata, condition_id)
+
+        for experiment in experiments:
+            self.completions[experiment] += 1
+
+    def summary(self):
+        with self._lock:
+            return {
+                experiment: {
+                    "completions": self.completions[experiment],
+                    "conditions": {condition: stats.as_dict()
+                                   for condition, stats
+                                   in sorted(conditions.items())},
+                }
+                for experiment, conditions in sorted(self.conditions.items())
+            }
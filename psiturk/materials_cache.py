@@ -0,0 +1,402 @@
+"""
+In-process cache of parsed materials files, shared across requests.
+
+Materials are addressed by ID, i.e. their path relative to the materials root
+without the `.json` suffix (e.g. `fillers/swarm_comprehension-000-base`).
+
+Materials may also be published to a content-addressed store under the
+materials root (see `src/materials_csv_to_json.py`):
+
+    objects/<hash[:2]>/<hash>.json   materials, keyed by SHA-256 of the file
+    aliases.json                     map from materials IDs to hashes
+
+Content hashes can be used directly as materials IDs, and other IDs are first
+resolved through the alias table. Stored materials never change, so they are
+never revalidated, and materials shared by several aliases are loaded once.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+from pathlib import Path
+import re
+import subprocess
+import threading
+import time
+
+
+L = logging.getLogger(__name__)
+
+
+class LoadedMaterials(dict):
+    """
+    Parsed materials, along with derived state compiled from them.
+
+    `compiled` maps arbitrary keys (e.g. a renderer class and pool type) to
+    state derived from these materials. It lives exactly as long as this
+    version of the materials, so it never needs separate invalidation.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compiled = {}
+        self._compilers = {}
+
+    def get_compiled(self, key, compile_fn):
+        """
+        Retrieve state derived from these materials by `compile_fn`, compiling
+        it on first request for `key`.
+        """
+        try:
+            return self.compiled[key]
+        except KeyError:
+            # NB two threads may race to compile the same key. That's
+            # harmless -- both results are equivalent, and `setdefault` keeps
+            # just one.
+            self._compilers.setdefault(key, compile_fn)
+            return self.compiled.setdefault(key, compile_fn(self))
+
+    def compile_like(self, other: "LoadedMaterials"):
+        """
+        Compile all state which has so far been compiled for `other` (e.g. a
+        previous version of these materials).
+        """
+        for key, compile_fn in list(other._compilers.items()):
+            self.get_compiled(key, compile_fn)
+
+
+ALIASES_FILE = "aliases.json"
+OBJECTS_DIR = "objects"
+
+_CONTENT_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_content_id(materials_id: str) -> bool:
+    """
+    Whether a materials ID is a content hash, which always refers to the same
+    materials.
+    """
+    return bool(_CONTENT_ID_RE.match(materials_id))
+
+
+class _CacheEntry(object):
+
+    __slots__ = ("materials", "mtime", "size", "checked_at")
+
+    def __init__(self, materials, mtime, size, checked_at):
+        self.materials = materials
+        self.mtime = mtime
+        self.size = size
+        self.checked_at = checked_at
+
+
+class MaterialsCache(object):
+    """
+    LRU cache of parsed materials, keyed by materials ID.
+
+    Cached entries are revalidated against the file's mtime and size at most
+    once every `check_interval` seconds, so that steady-state lookups don't
+    touch the disk. Memory use is bounded by the total on-disk size of cached
+    files, which is a reasonable proxy for the size of the parsed materials.
+
+    Returned materials are shared between all callers and must not be
+    mutated.
+    """
+
+    def __init__(self, root="/materials", max_bytes=64 * 1024 * 1024,
+                 check_interval=1.0):
+        """
+        Args:
+            root: Directory containing materials `.json` files.
+            max_bytes: Evict least recently used materials once the total size
+                of cached files exceeds this bound.
+            check_interval: Minimum number of seconds between `stat` checks
+                of a cached file. Set to 0 to check on every lookup.
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._aliases = {}
+        self._aliases_mtime = None
+        self._aliases_checked_at = None
+
+    def path_for(self, materials_id: str) -> Path:
+        if ".." in materials_id:
+            raise ValueError('STOP, injection attack detected', 400)
+
+        return self.root / f"{materials_id}.json"
+
+    def object_path_for(self, content_id: str) -> Path:
+        return self.root / OBJECTS_DIR / content_id[:2] / f"{content_id}.json"
+
+    def reload_aliases(self):
+        """
+        Re-read the alias table, if it has changed.
+        """
+        path = self.root / ALIASES_FILE
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        with self._lock:
+            self._aliases_checked_at = time.monotonic()
+            if mtime == self._aliases_mtime:
+                return
+
+        aliases = {}
+        if mtime is not None:
+            try:
+                with path.open() as f:
+                    aliases = json.load(f)
+            except ValueError:
+                L.warning("could not parse materials aliases; keeping previous version")
+                return
+
+        with self._lock:
+            self._aliases = aliases
+            self._aliases_mtime = mtime
+        L.info("loaded %i materials aliases", len(aliases))
+
+    def resolve(self, materials_id: str):
+        """
+        Resolve a materials ID to a content hash, or `None` if the materials
+        are not in the content-addressed store.
+        """
+        if is_content_id(materials_id):
+            return materials_id
+
+        checked_at = self._aliases_checked_at
+        if checked_at is None or time.monotonic() - checked_at >= self.check_interval:
+            self.reload_aliases()
+
+        return self._aliases.get(materials_id)
+
+    def get(self, materials_id: str):
+        """
+        Retrieve parsed materials with the given ID, loading them from disk if
+        they are not cached or if the file has changed since it was cached.
+
+        Raises:
+            ValueError: with args `(message, http_status)` if the materials ID
+                is invalid or cannot be found.
+        """
+        content_id = self.resolve(materials_id)
+        if content_id is not None:
+            return self._get_object(content_id, materials_id)
+
+        path = self.path_for(materials_id)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(materials_id)
+            if entry is not None and now - entry.checked_at < self.check_interval:
+                self._entries.move_to_end(materials_id)
+                self.hits += 1
+                return entry.materials
+
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self.discard(materials_id)
+            raise ValueError(f'could not find materials with id {materials_id}', 404)
+
+        with self._lock:
+            entry = self._entries.get(materials_id)
+            if entry is not None and entry.mtime == stat.st_mtime_ns \
+                    and entry.size == stat.st_size:
+                entry.checked_at = now
+                self._entries.move_to_end(materials_id)
+                self.hits += 1
+                return entry.materials
+
+            self.misses += 1
+
+        L.debug("loading materials %s from %s", materials_id, path)
+        with path.open() as f:
+            materials = LoadedMaterials(json.load(f))
+
+        with self._lock:
+            self._store(materials_id, _CacheEntry(
+                materials, stat.st_mtime_ns, stat.st_size, now))
+
+        return materials
+
+    def _get_object(self, content_id: str, materials_id: str):
+        with self._lock:
+            entry = self._entries.get(content_id)
+            if entry is not None:
+                self._entries.move_to_end(content_id)
+                self.hits += 1
+                return entry.materials
+
+            self.misses += 1
+
+        path = self.object_path_for(content_id)
+        L.debug("loading materials %s from %s", materials_id, path)
+        try:
+            with path.open() as f:
+                materials = LoadedMaterials(json.load(f))
+            size = path.stat().st_size
+        except FileNotFoundError:
+            raise ValueError(f'could not find materials with id {materials_id}', 404)
+
+        with self._lock:
+            # Another thread may have loaded the same object meanwhile. Keep
+            # one copy, so that all callers share its compiled state.
+            entry = self._entries.get(content_id)
+            if entry is not None:
+                return entry.materials
+            self._store(content_id, _CacheEntry(materials, None, size,
+                                                time.monotonic()))
+
+        return materials
+
+    def _store(self, materials_id, entry):
+        old_entry = self._entries.pop(materials_id, None)
+        if old_entry is not None:
+            self._total_bytes -= old_entry.size
+
+        self._entries[materials_id] = entry
+        self._total_bytes += entry.size
+
+        # Evict least recently used entries, but always keep the newest one.
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= evicted.size
+            self.evictions += 1
+            L.info("evicted materials %s from cache", evicted_id)
+
+    def reload(self, materials_id: str):
+        """
+        Re-parse cached materials from disk and compile the same state as for
+        their previous version, then swap them in atomically. Requests which
+        already hold the previous version keep using it consistently.
+
+        Materials which are not cached are left to be loaded on demand.
+        """
+        with self._lock:
+            old_entry = self._entries.get(materials_id)
+        if old_entry is None or old_entry.mtime is None:
+            # Not cached, or immutable
+            return
+
+        path = self.path_for(materials_id)
+        try:
+            stat = path.stat()
+            with path.open() as f:
+                materials = LoadedMaterials(json.load(f))
+        except FileNotFoundError:
+            self.discard(materials_id)
+            return
+        except ValueError:
+            # e.g. a partially written file. We'll get another event once
+            # it's complete.
+            L.warning("could not parse materials %s; keeping previous version",
+                      materials_id)
+            return
+
+        materials.compile_like(old_entry.materials)
+
+        with self._lock:
+            if self._entries.get(materials_id) is old_entry:
+                self._store(materials_id, _CacheEntry(
+                    materials, stat.st_mtime_ns, stat.st_size, time.monotonic()))
+                L.info("reloaded materials %s", materials_id)
+
+    def discard(self, materials_id: str):
+        with self._lock:
+            entry = self._entries.pop(materials_id, None)
+            if entry is not None:
+                self._total_bytes -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "aliases": len(self._aliases),
+            }
+
+
+class MaterialsWatcher(object):
+    """
+    Watches the materials root with `inotifywait` (from inotify-tools), and
+    reloads cached materials in the background as soon as their files change.
+
+    While the watcher runs, the cache no longer checks files on lookup.
+    """
+
+    def __init__(self, cache: MaterialsCache):
+        self.cache = cache
+        self._process = None
+        self._check_interval = cache.check_interval
+
+    def start(self) -> bool:
+        """
+        Start watching. Returns `False` if `inotifywait` is unavailable, in
+        which case the cache keeps checking files on lookup.
+        """
+        try:
+            self._process = subprocess.Popen(
+                ["inotifywait", "--monitor", "--recursive", "--quiet",
+                 "--event", "close_write,moved_to,moved_from,delete",
+                 "--format", "%w%f", str(self.cache.root)],
+                stdout=subprocess.PIPE, universal_newlines=True)
+        except FileNotFoundError:
+            L.warning("inotifywait not found; not watching materials for changes")
+            return False
+
+        self.cache.check_interval = float("inf")
+        threading.Thread(target=self._run, daemon=True,
+                         name="materials-watcher").start()
+        return True
+
+    def _materials_id(self, path: str):
+        path = Path(path)
+        if path.suffix != ".json":
+            return None
+
+        try:
+            return path.relative_to(self.cache.root).with_suffix("").as_posix()
+        except ValueError:
+            return None
+
+    def _run(self):
+        aliases_path = str(self.cache.root / ALIASES_FILE)
+        for line in self._process.stdout:
+            path = line.rstrip("\n")
+            if path == aliases_path:
+                self.cache.reload_aliases()
+                continue
+
+            materials_id = self._materials_id(path)
+            if materials_id is None:
+                continue
+
+            try:
+                self.cache.reload(materials_id)
+            except Exception:
+                L.exception("failed to reload materials %s", materials_id)
+
+        # Fall back to checking files on lookup.
+        L.error("inotifywait exited; no longer watching materials for changes")
+        self.cache.check_interval = self._check_interval
@@ -0,0 +1,189 @@
+"""
+Lightweight in-process metrics, exported in the Prometheus text format.
+
+Request handlers time named stages of their work with `stage`. Stages are
+only recorded while a `StageTimer` is active in the current thread, so that
+instrumented code costs next to nothing elsewhere (e.g. in offline tools).
+Stage times are inclusive of any nested stages.
+"""
+
+from collections import defaultdict
+import threading
+import time
+
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                          for key, value in labels) + "}"
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe store of counters and histograms, keyed by metric name and
+    label set.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[name, tuple(labels)] += value
+
+    def observe(self, name, value, labels=()):
+        key = (name, tuple(labels))
+        with self._lock:
+            try:
+                histogram = self._histograms[key]
+            except KeyError:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self, gauges=()):
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        Args:
+            gauges: Additional `(name, labels, value)` gauge samples, e.g.
+                cache statistics collected at scrape time.
+        """
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(),
+                                key=lambda item: item[0])
+
+            last_name = None
+            for (name, labels), value in counters:
+                if name != last_name:
+                    header(name, "counter")
+                    last_name = name
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+            last_name = None
+            for (name, labels), histogram in histograms:
+                if name != last_name:
+                    header(name, "histogram")
+                    last_name = name
+
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    bucket_labels = labels + (("le", f"{bound:g}"),)
+                    lines.append(f"{name}_bucket{_format_labels(bucket_labels)} "
+                                 f"{cumulative}")
+                bucket_labels = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_format_labels(bucket_labels)} "
+                             f"{histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum:g}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        last_name = None
+        for name, labels, value in sorted(gauges, key=lambda g: g[:2]):
+            if name != last_name:
+                header(name, "gauge")
+                last_name = name
+            lines.append(f"{name}{_format_labels(tuple(labels))} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+#####################
+
+
+_local = threading.local()
+
+
+class StageTimer(object):
+    """
+    Accumulates the time spent in named stages of a single request, in the
+    current thread.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+
+    def __enter__(self):
+        self._previous = getattr(_local, "timer", None)
+        _local.timer = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.timer = self._previous
+
+
+class _Stage(object):
+
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.totals[self.name] += time.perf_counter() - self.start
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """
+    Context manager timing a named stage of the current request, if any.
+    """
+    timer = getattr(_local, "timer", None)
+    if timer is None:
+        return _NULL_STAGE
+
+    return _Stage(timer, name)
@@ -0,0 +1,118 @@
+"""
+Background pre-rendering of trial lists, so that serving a list only requires
+popping it from a queue.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from renderers import TRIAL_RENDERERS
+
+
+L = logging.getLogger(__name__)
+
+
+class PrerenderedTrialPool(object):
+    """
+    Keeps a bounded queue of ready-made trial lists for each requested
+    (experiment, materials) pair, refilled by a background worker thread.
+
+    Lists are rendered without request arguments. Each queued list remembers
+    the materials it was rendered from, and lists rendered from materials
+    which have since changed are discarded rather than served.
+    """
+
+    def __init__(self, load_materials, size=20):
+        """
+        Args:
+            load_materials: Function mapping a materials ID to parsed
+                materials, e.g. `MaterialsCache.get`.
+            size: Maximum number of lists kept ready per (experiment,
+                materials) pair.
+        """
+        self.load_materials = load_materials
+        self.size = size
+
+        self._queues = {}
+        self._pending = set()
+        self._refills = queue.Queue()
+        self._lock = threading.Lock()
+
+        self._worker = threading.Thread(target=self._run, daemon=True,
+                                        name="trial-prerender")
+
+    def start(self):
+        self._worker.start()
+
+    def _get_queue(self, key):
+        with self._lock:
+            try:
+                return self._queues[key]
+            except KeyError:
+                return self._queues.setdefault(key, queue.Queue(self.size))
+
+    def _request_refill(self, key):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._refills.put(key)
+
+    def pop(self, experiment, materials_id, materials):
+        """
+        Pop a ready-made trial list rendered from `materials`, or return
+        `None` if none is available. Either way, schedules a refill of the
+        queue for this experiment and materials.
+        """
+        key = (experiment, tuple(materials_id))
+        trial_queue = self._get_queue(key)
+
+        try:
+            rendered_from, trials = trial_queue.get_nowait()
+        except queue.Empty:
+            trials = None
+        else:
+            if any(a is not b for a, b in zip(rendered_from, materials)):
+                # Materials have changed since this list was rendered. Drop
+                # all lists rendered from the old version.
+                L.info("dropping stale prerendered trials for %s", key)
+                trials = None
+                with trial_queue.mutex:
+                    trial_queue.queue.clear()
+
+        self._request_refill(key)
+        return trials
+
+    def _fill(self, key):
+        experiment, materials_id = key
+        renderer_cls = TRIAL_RENDERERS[experiment]
+        trial_queue = self._get_queue(key)
+
+        while not trial_queue.full():
+            materials = tuple(self.load_materials(id) for id in materials_id)
+            trials = renderer_cls(experiment).get_trials(
+                materials, list(materials_id))
+
+            try:
+                trial_queue.put_nowait((materials, trials))
+            except queue.Full:
+                break
+
+            # Yield between renders. Under gevent workers this thread is a
+            # greenlet (and `time.sleep` is patched), so rendering a whole
+            # batch without yielding would block every request in the
+            # process.
+            time.sleep(0)
+
+    def _run(self):
+        while True:
+            key = self._refills.get()
+            with self._lock:
+                self._pending.discard(key)
+
+            try:
+                self._fill(key)
+            except Exception:
+                L.exception("failed to prerender trials for %s", key)
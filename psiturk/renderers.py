@@ -3,60 +3,285 @@ Defines "trial renderers" which convert experimental materials into actual
 raw data for trial sequences. Final minimal rendering happens on frontend.
 """
 
+from collections import defaultdict
 import functools
 import itertools
 import math
 import random
 import re
+from types import MappingProxyType
 
-from util import random_name
+from metrics import stage
+from util import NAMES
+
+
+def get_compiled(materials, key, compile_fn):
+    """
+    Retrieve state derived from `materials` by `compile_fn`, compiling it only
+    once per `key` for materials which support it (see
+    `materials_cache.LoadedMaterials`). Other materials are compiled on every
+    call.
+    """
+    if not hasattr(materials, "get_compiled"):
+        return compile_fn(materials)
+
+    return materials.get_compiled(key, compile_fn)
+
+
+class FieldTemplate(object):
+    """
+    A materials field compiled into literal segments separated by
+    `%PERSON<id>[_<subtype>]%` placeholder slots, so that rendering is just a
+    slot fill and join.
+    """
+
+    __slots__ = ("literals", "slots", "constant", "_filled")
+
+    PLACEHOLDER_RE = re.compile(r"%PERSON(\d+)(?:_([^%]+))?%")
+
+    def __init__(self, literals, slots):
+        """
+        Args:
+            literals: Literal segments, one more than there are slots.
+            slots: `(name_id, subtype)` of each placeholder.
+        """
+        self.literals = tuple(literals)
+        self.slots = tuple(slots)
+
+        # Fields without placeholders render to themselves
+        self.constant = self.literals[0] if not self.slots else None
+
+        # Each slot with the literal segment following it
+        self._filled = tuple(zip(self.slots, self.literals[1:]))
+
+    @classmethod
+    def parse(cls, text: str) -> "FieldTemplate":
+        # `split` alternates literal segments with the two placeholder groups
+        parts = cls.PLACEHOLDER_RE.split(text)
+        return cls(parts[::3], zip(parts[1::3], parts[2::3]))
+
+    @classmethod
+    def join(cls, parts, sep="") -> "FieldTemplate":
+        """
+        Concatenate templates and literal strings (which are not parsed for
+        placeholders) into a single template.
+        """
+        literals, slots = [""], []
+        for i, part in enumerate(parts):
+            if i > 0:
+                literals[-1] += sep
+
+            if isinstance(part, FieldTemplate):
+                literals[-1] += part.literals[0]
+                slots.extend(part.slots)
+                literals.extend(part.literals[1:])
+            else:
+                literals[-1] += part
+
+        return cls(literals, slots)
+
+    def strip(self, chars=None) -> "FieldTemplate":
+        # NB names never begin or end with whitespace or punctuation, so it's
+        # enough to strip the outer literal segments.
+        literals = list(self.literals)
+        literals[0] = literals[0].lstrip(chars)
+        literals[-1] = literals[-1].rstrip(chars)
+        return FieldTemplate(literals, self.slots)
+
+    def render(self, replace_fn) -> str:
+        """
+        Args:
+            replace_fn: Function `f(name_id, subtype)` returning the value of
+                a placeholder. `subtype` is `None` for plain names.
+        """
+        if self.constant is not None:
+            return self.constant
+
+        parts = [self.literals[0]]
+        for (name_id, subtype), literal in self._filled:
+            parts += (replace_fn(name_id, subtype), literal)
+        return "".join(parts)
+
+
+# NB keyed by field text, so that compiled templates are shared by all items
+# and materials versions with the same field values.
+compile_field = functools.lru_cache(maxsize=65536)(FieldTemplate.parse)
+
+
+class MaterialsPool(object):
+    """
+    Immutable pool of eligible materials items, optionally partitioned by the
+    value of some item field (e.g. filler `rating`).
+    """
+
+    __slots__ = ("items", "partitions", "skeletons")
+
+    def __init__(self, items, partition_field=None, skeleton_fn=None):
+        """
+        Args:
+            items:
+            partition_field:
+            skeleton_fn: Optional function building the skeleton of each
+                item (see `TrialRenderer.build_skeleton`).
+        """
+        self.items = tuple(items)
+
+        partitions = defaultdict(list)
+        if partition_field is not None:
+            for item in self.items:
+                partitions[item[partition_field]].append(item)
+        self.partitions = MappingProxyType(
+            {key: tuple(part) for key, part in partitions.items()})
+
+        # NB keyed by `id`, which is stable since the pool holds its items
+        skeletons = {}
+        if skeleton_fn is not None:
+            for item in self.items:
+                try:
+                    skeletons[id(item)] = skeleton_fn(item)
+                except (KeyError, TypeError, ValueError):
+                    # Items with bad data fail once they're rendered instead
+                    pass
+        self.skeletons = MappingProxyType(skeletons)
+
+    def __len__(self):
+        return len(self.items)
+
+    def partition(self, key):
+        return self.partitions.get(key, ())
 
 
 class TrialRenderer(object):
-    # NB not threadsafe.
+    """
+    Renders trial lists for a single experiment.
 
-    def __init__(self, experiment_name):
+    A renderer instance holds the state of a single render -- its random
+    number generator and the template variables of the current trial -- and
+    should only be used by one thread at a time. Create one instance per
+    request. State compiled from materials is shared safely across instances.
+    """
+
+    # Optional `images.ImageManifest`, used to add content versions to the
+    # image paths in rendered trials.
+    image_manifest = None
+
+    # Trial fields read by the experiment's frontend, which are the only
+    # fields sent in compact response formats. `None` sends all fields.
+    frontend_fields = None
+
+    def __init__(self, experiment_name, rng=None):
+        """
+        Args:
+            experiment_name:
+            rng: `random.Random` instance used for all random draws in this
+                render. By default, a new independently seeded instance.
+        """
         self.experiment_name = experiment_name
+        self.random = rng if rng is not None else random.Random()
 
         # Template variables deployed in a given item/trial
-        self._var_cache = {}
+        self._reset_var_cache()
+
+        # Skeletons of the items in the current experimental pool
+        self._skeletons = {}
 
     def _reset_var_cache(self):
         self._var_cache = {}
 
-    def _draw_name(self):
-        existing_names = set([name for k, name in self._var_cache.items()
-                              if k.startswith("PERSON")])
-
-        # rejection-sample a unique name
-        name, gender = random_name()
-        while name in existing_names:
-            name, gender = random_name()
+        # Names of the persons drawn for the current trial
+        self._names = []
 
+    def _draw_name(self):
+        # Draw a name distinct from the others in this trial. NB each
+        # person's gender is drawn independently, so that trials may have
+        # persons of the same gender.
+        name, gender = NAMES.draw(rng=self.random, exclude=self._names)
+        self._names.append(name)
         return name, gender
 
     def _replace_name(self, name_id: str, subtype: str = None):
-        if f"PERSON{name_id}" in self._var_cache:
-            return self._var_cache[f"PERSON{name_id}"
-                                   + (f"_{subtype}" if subtype else "")]
+        key = f"PERSON{name_id}_{subtype}" if subtype else f"PERSON{name_id}"
+        try:
+            return self._var_cache[key]
+        except KeyError:
+            if f"PERSON{name_id}" in self._var_cache:
+                # Unknown subtype of an existing person
+                raise
 
         name, gender = self._draw_name()
         self._var_cache[f"PERSON{name_id}"] = name
         self._var_cache[f"PERSON{name_id}_POSS"] = \
             "her" if gender == "female" else "his"
 
-        return self._replace_name(name_id, subtype=subtype)
+        return self._var_cache[key]
 
     def process_field(self, item_data, field):
-        field = item_data[field]
+        # Fill person name variables and related possessives
+        with stage("process_field"):
+            return self.fill(compile_field(item_data[field]))
+
+    def fill(self, template: FieldTemplate) -> str:
+        return template.render(self._replace_name)
+
+    def image_path(self, materials_id: str, path: str) -> str:
+        """
+        Get the path of an image relative to the directory of the materials
+        with the given ID, with a content version if available.
+        """
+        if self.image_manifest is None:
+            return path
 
-        # Find--replace person name variables and related possessives
-        field = re.sub(
-            r"%PERSON(\d+)(?:_([^%]+))?%",
-            lambda match: self._replace_name(match.group(1), match.group(2)),
-            field)
+        return self.image_manifest.versioned_path(path, relative_to=materials_id)
 
-        return field
+    def _filter_materials(self, materials):
+        return materials["items"]
+
+    def build_skeleton(self, item) -> dict:
+        """
+        Build the parts of an item's trials which depend neither on drawn
+        names nor on other random draws, e.g. sentences in all conditions.
+        Parts which contain names are `FieldTemplate`s, to be `fill`ed when
+        rendering a trial.
+
+        Skeletons are built once per item and materials version, so this must
+        not depend on any render state.
+        """
+        return {}
+
+    def get_skeleton(self, item) -> dict:
+        try:
+            return self._skeletons[id(item)]
+        except KeyError:
+            return self.build_skeleton(item)
+
+    def get_exp_pool(self, materials) -> MaterialsPool:
+        """
+        Get the pool of experimental items eligible for this renderer.
+        """
+        def compile_pool(materials):
+            with stage("filtering"):
+                return MaterialsPool(self._filter_materials(materials),
+                                     skeleton_fn=self.build_skeleton)
+
+        pool = get_compiled(materials, (type(self), "exp"), compile_pool)
+        self._skeletons = pool.skeletons
+        return pool
+
+    def build_trials(self, items, conditions, materials_id):
+        """
+        Build one trial per item, in the corresponding condition.
+        """
+        with stage("build_trial"):
+            return [self.build_trial(item, condition, materials_id)
+                    for item, condition in zip(items, conditions)]
+
+    def get_filler_pool(self, materials, partition_field=None) -> MaterialsPool:
+        """
+        Get the pool of all filler items, partitioned by `partition_field`.
+        """
+        return get_compiled(
+            materials, ("filler", partition_field),
+            lambda materials: MaterialsPool(materials["items"], partition_field))
 
     def get_trials(self, materials: list, materials_id: str, args=None):
         """
@@ -78,15 +303,69 @@ class TrialRenderer(object):
 
 TRIAL_RENDERERS = {}
 
+# Materials IDs requested by each experiment's frontend, in order.
+EXPERIMENT_MATERIALS = {}
+
 
-def register_trial_renderer(experiment_name):
+def register_trial_renderer(experiment_name, materials=()):
     def decorator(cls):
         TRIAL_RENDERERS[experiment_name] = cls
+        EXPERIMENT_MATERIALS[experiment_name] = tuple(materials)
         return cls
 
     return decorator
 
 
+def render_trials(experiment_name, materials, materials_id, seed=None,
+                  args=None):
+    """
+    Render a single trial list for the given experiment.
+
+    Given a `seed`, rendering is a pure function of `(experiment_name,
+    materials, materials_id, seed)`, so that the same list can be reproduced
+    later (e.g. offline, from a participant's seed).
+
+    Args:
+        experiment_name:
+        materials:
+        materials_id:
+        seed: Optional seed for all random draws, e.g. a participant's
+            `uniqueId`.
+        args: Other arguments from the request.
+    """
+    renderer = TRIAL_RENDERERS[experiment_name](
+        experiment_name, rng=random.Random(seed))
+    return renderer.get_trials(materials, materials_id, args=args)
+
+
+def render_trial_lists(experiment_name, materials, materials_id, n: int,
+                       args=None, rng=None):
+    """
+    Render `n` independent trial lists for the given experiment in one call,
+    sharing loaded materials and their compiled state across all lists.
+
+    Args:
+        experiment_name:
+        materials:
+        materials_id:
+        n: Number of trial lists to render.
+        args: Other arguments from the request.
+        rng: `random.Random` instance from which each list's generator is
+            seeded. By default, a new independently seeded instance.
+
+    Returns:
+        List of `n` rendered trial lists, as returned by
+        `TrialRenderer.get_trials`.
+    """
+    renderer_cls = TRIAL_RENDERERS[experiment_name]
+    if rng is None:
+        rng = random.Random()
+
+    return [renderer_cls(experiment_name, rng=random.Random(rng.getrandbits(64)))
+            .get_trials(materials, materials_id, args=args)
+            for _ in range(n)]
+
+
 class SwarmPilotRenderer(TrialRenderer):
 
     # Drop materials items which have empty values for any of these fields.
@@ -105,11 +384,26 @@ class SwarmPilotRenderer(TrialRenderer):
         return items
 
     def _filter_and_sample_materials(self, materials):
-        items = self._filter_materials(materials)
-        items = random.sample(items, self.NUM_EXP_TRIALS)
+        pool = self.get_exp_pool(materials)
+        with stage("sampling"):
+            items = self.random.sample(pool.items, self.NUM_EXP_TRIALS)
 
         return items
 
+    def build_skeleton(self, item):
+        skeleton = super().build_skeleton(item)
+
+        skeleton["prompt"] = FieldTemplate.join([
+            "How", "many" if item["A countable?"] else "much",
+            item["A"],
+            "are" if item["A countable?"] else "is",
+            item["prompt P"],
+            compile_field(item["L det"]),
+            item["L"] + "?"
+        ], sep=" ")
+
+        return skeleton
+
     def build_trial(self, item, condition, materials_id):
         self._reset_var_cache()
 
@@ -147,10 +441,11 @@ class SwarmPilotRenderer(TrialRenderer):
         exp_trials = self.get_exp_trials(exp_materials)
 
         num_fillers = self.TOTAL_NUM_TRIALS - self.NUM_EXP_TRIALS
-        filler_trials = self.get_filler_trials(filler_materials, num_fillers)
+        with stage("fillers"):
+            filler_trials = self.get_filler_trials(filler_materials, num_fillers)
 
         trials = exp_trials + filler_trials
-        random.shuffle(trials)
+        self.random.shuffle(trials)
 
         ret = dict(experiment=self.experiment_name, materials_id=materials_id,
                    trials=trials)
@@ -164,6 +459,31 @@ class SwarmNPPilotRenderer(SwarmPilotRenderer):
     uses swarm-alternation with actual NPs (as opposed to pronouns)
     """
 
+    def build_skeleton(self, item):
+        skeleton = super().build_skeleton(item)
+
+        location_determiner = compile_field(item["L det"])
+        skeleton["critical_clause"] = {
+            "agent": FieldTemplate.join([
+                item["A"], " ",
+                "are" if item["A countable?"] else "is", " ",
+                item["V"], "ing ",
+                item["P"], " ",
+                location_determiner, " ",
+                item["L"],
+            ]),
+
+            "location": FieldTemplate.join([
+                location_determiner, " ",
+                item["L"], " ",
+                "are" if item["L plural?"] else "is", " ",
+                item["V"], "ing with ",
+                item["A"],
+            ]),
+        }
+
+        return skeleton
+
     def build_trial(self, item, condition, materials_id):
         trial = super().build_trial(item, condition, materials_id)
 
@@ -176,24 +496,9 @@ class SwarmNPPilotRenderer(SwarmPilotRenderer):
             "location": p("topic L"),
         }
 
+        critical_clause = self.get_skeleton(item)["critical_clause"]
         trial["critical_clause"] = {
-            "agent": "".join([
-                trial["agent"], " ",
-                "are" if trial["agent_plural"] else "is", " ",
-                trial["verb"], "ing ",
-                trial["preposition"], " ",
-                trial["location_determiner"], " ",
-                trial["location"],
-            ]),
-
-            "location": "".join([
-                trial["location_determiner"], " ",
-                trial["location"], " ",
-                "are" if trial["location_plural"] else "is", " ",
-                trial["verb"], "ing with ",
-                trial["agent"],
-            ]),
-        }
+            key: self.fill(clause) for key, clause in critical_clause.items()}
 
         return trial
 
@@ -210,6 +515,37 @@ class SwarmAnaphorPilotRenderer(SwarmPilotRenderer):
          "given A pron obj", "given L pron subj",
          "given L pron obj"]
 
+    def build_skeleton(self, item):
+        skeleton = super().build_skeleton(item)
+
+        location_np = FieldTemplate.join(
+            [compile_field(item["L det"]), item["L"]], sep=" ")
+
+        # Critical clauses when the agent is given / not given
+        skeleton["critical_clause"] = {
+            agent_is_given: {
+                "agent": FieldTemplate.join([
+                    item["given A pron subj"] if agent_is_given else item["A"],
+                    " ",
+                    "are" if item["A countable?"] else "is", " ",
+                    item["V"], "ing ",
+                    item["P"], " ",
+                    location_np if agent_is_given else item["given L pron obj"],
+                ]),
+
+                "location": FieldTemplate.join([
+                    location_np if agent_is_given else item["given L pron subj"],
+                    " ",
+                    "are" if item["L plural?"] else "is", " ",
+                    item["V"], "ing with ",
+                    item["given A pron obj"] if agent_is_given else item["A"],
+                ]),
+            }
+            for agent_is_given in (False, True)
+        }
+
+        return skeleton
+
     def build_trial(self, item, condition, materials_id):
         trial = super().build_trial(item, condition, materials_id)
 
@@ -231,36 +567,21 @@ class SwarmAnaphorPilotRenderer(SwarmPilotRenderer):
             "location": p("given L"),
         }
 
+        critical_clause = \
+            self.get_skeleton(item)["critical_clause"][bool(agent_is_given)]
         trial["critical_clause"] = {
-            "agent": "".join([
-                trial["agent_pronoun_subject"]
-                    if agent_is_given else trial["agent"], " ",
-                "are" if trial["agent_plural"] else "is", " ",
-                trial["verb"], "ing ",
-                trial["preposition"], " ",
-                "".join([trial["location_determiner"], " ",
-                         trial["location"]])
-                    if agent_is_given else trial["location_pronoun_object"],
-            ]),
-
-            "location": "".join([
-                "".join([trial["location_determiner"], " ",
-                         trial["location"]])
-                    if agent_is_given else trial["location_pronoun_subject"],
-                " ",
-                "are" if trial["location_plural"] else "is", " ",
-                trial["verb"], "ing with ",
-                trial["agent_pronoun_object"]
-                    if agent_is_given else trial["agent"],
-            ]),
-        }
+            key: self.fill(clause) for key, clause in critical_clause.items()}
 
         return trial
 
 
-@register_trial_renderer("00_comprehension_swarm-construction-meaning")
+@register_trial_renderer("00_comprehension_swarm-construction-meaning",
+                         materials=["swarm-003-drops",
+                                    "fillers/swarm_comprehension-000-base"])
 class ComprehensionSwarmMeaningRenderer(SwarmNPPilotRenderer):
 
+    frontend_fields = ["item_id", "condition_id", "sentence", "prompt"]
+
     TOTAL_NUM_TRIALS = 30
     NUM_EXP_TRIALS = 18
 
@@ -272,28 +593,20 @@ class ComprehensionSwarmMeaningRenderer(SwarmNPPilotRenderer):
                                           else "location"]
         trial["sentence"] = clause.capitalize() + "."
 
-        trial["prompt"] = " ".join([
-            "How", "many" if trial["agent_plural"] else "much",
-            trial["agent"],
-            "are" if trial["agent_plural"] else "is",
-            trial["prompt_preposition"],
-            trial["location_determiner"],
-            trial["location"]
-        ]) + "?"
+        trial["prompt"] = self.fill(self.get_skeleton(item)["prompt"])
 
         return trial
 
     def get_filler_trials(self, materials, num_trials: int):
-        empty_items = [item for item in materials["items"]
-                       if item["rating"] == "empty"]
-        full_items = [item for item in materials["items"]
-                      if item["rating"] == "full"]
+        pool = self.get_filler_pool(materials, "rating")
+        empty_items = pool.partition("empty")
+        full_items = pool.partition("full")
 
         # Sample an equal balance of "empty" and "full"
         num_empty = num_trials // 2
 
-        bad_trials = random.sample(empty_items, num_empty)
-        good_trials = random.sample(full_items, num_trials - num_empty)
+        bad_trials = self.random.sample(empty_items, num_empty)
+        good_trials = self.random.sample(full_items, num_trials - num_empty)
         all_trials = bad_trials + good_trials
 
         all_trials = [{
@@ -317,16 +630,19 @@ class ComprehensionSwarmMeaningRenderer(SwarmNPPilotRenderer):
             (0, 1),  # topic = l, subject = a
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
-@register_trial_renderer("01_production_swarm-topicality")
+@register_trial_renderer("01_production_swarm-topicality",
+                         materials=["swarm-003-drops",
+                                    "fillers/swarm_production-000-base"])
 class ProductionSwarmTopicalityRenderer(SwarmNPPilotRenderer):
 
+    frontend_fields = ["item_id", "condition_id", "sentences", "conjunction"]
+
     TOTAL_NUM_TRIALS = 30
     NUM_EXP_TRIALS = 18
 
@@ -346,7 +662,7 @@ class ProductionSwarmTopicalityRenderer(SwarmNPPilotRenderer):
         return trial
 
     def get_filler_trials(self, materials, num_trials: int):
-        trials = random.sample(materials["items"], num_trials)
+        trials = self.random.sample(self.get_filler_pool(materials).items, num_trials)
 
         def build_trial(t):
             good_sentence = "".join(
@@ -379,24 +695,24 @@ class ProductionSwarmTopicalityRenderer(SwarmNPPilotRenderer):
             (1, 1),  # topic = a, subject = a
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
 class AcceptabilityFillerMixin(object):
 
     def get_filler_trials(self, materials, num_trials: int):
-        bad_items = [item for item in materials["items"] if item["rating"] == "bad"]
-        good_items = [item for item in materials["items"] if item["rating"] == "good"]
+        pool = self.get_filler_pool(materials, "rating")
+        bad_items = pool.partition("bad")
+        good_items = pool.partition("good")
 
         # Sample an equal balance of "bad" and "good"
         num_bad = num_trials // 2
 
-        bad_trials = random.sample(bad_items, num_bad)
-        good_trials = random.sample(good_items, num_trials - num_bad)
+        bad_trials = self.random.sample(bad_items, num_bad)
+        good_trials = self.random.sample(good_items, num_trials - num_bad)
         all_trials = bad_trials + good_trials
 
         all_trials = [{
@@ -405,13 +721,17 @@ class AcceptabilityFillerMixin(object):
             "sentence": self.process_field(trial, "sentence"),
         } for trial in all_trials]
 
-        random.shuffle(all_trials)
+        self.random.shuffle(all_trials)
 
         return all_trials
 
 
-@register_trial_renderer("02_acceptability_swarm")
-class AcceptabilitySwarmRenderer(SwarmNPPilotRenderer, AcceptabilityFillerMixin):
+@register_trial_renderer("02_acceptability_swarm",
+                         materials=["swarm-003-drops",
+                                    "fillers/swarm_acceptability-000-base"])
+class AcceptabilitySwarmRenderer(AcceptabilityFillerMixin, SwarmNPPilotRenderer):
+
+    frontend_fields = ["item_id", "condition_id", "sentence"]
 
     TOTAL_NUM_TRIALS = 38
     NUM_EXP_TRIALS = 18
@@ -436,16 +756,19 @@ class AcceptabilitySwarmRenderer(SwarmNPPilotRenderer, AcceptabilityFillerMixin)
             (0, 1),  # topic = b, subject = a
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
-@register_trial_renderer("08_acceptability_swarm-withprefix")
+@register_trial_renderer("08_acceptability_swarm-withprefix",
+                         materials=["swarm-004-given",
+                                    "fillers/swarm_acceptability-001-withprefix"])
 class AcceptabilitySwarmFullRenderer(AcceptabilityFillerMixin, SwarmAnaphorPilotRenderer):
 
+    frontend_fields = ["item_id", "condition_id", "sentence"]
+
     TOTAL_NUM_TRIALS = 38
     NUM_EXP_TRIALS = 18
 
@@ -474,16 +797,19 @@ class AcceptabilitySwarmFullRenderer(AcceptabilityFillerMixin, SwarmAnaphorPilot
             (1, 1),  # given = a, subject = a
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
-@register_trial_renderer("03_production_swarm-givenness")
+@register_trial_renderer("03_production_swarm-givenness",
+                         materials=["swarm-004-given",
+                                    "fillers/swarm_production-001-twosentences"])
 class ProductionSwarmGivennessRenderer(SwarmAnaphorPilotRenderer):
 
+    frontend_fields = ["item_id", "condition_id", "sentences"]
+
     TOTAL_NUM_TRIALS = 30
     NUM_EXP_TRIALS = 18
 
@@ -505,7 +831,7 @@ class ProductionSwarmGivennessRenderer(SwarmAnaphorPilotRenderer):
         return trial
 
     def get_filler_trials(self, materials, num_trials: int):
-        trials = random.sample(materials["items"], num_trials)
+        trials = self.random.sample(self.get_filler_pool(materials).items, num_trials)
 
         def build_trial(t):
             good_sentence = "".join(
@@ -539,16 +865,20 @@ class ProductionSwarmGivennessRenderer(SwarmAnaphorPilotRenderer):
             (1, 1),  # given = a, subject = a
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
-@register_trial_renderer("04_comprehension_swarm-full")
+@register_trial_renderer("04_comprehension_swarm-full",
+                         materials=["swarm-004-given",
+                                    "fillers/swarm_comprehension-000-base"])
 class ComprehensionSwarmFullRenderer(SwarmAnaphorPilotRenderer):
 
+    frontend_fields = ["materials_id", "item_id", "condition_id", "sentences",
+                       "prompt"]
+
     TOTAL_NUM_TRIALS = 30
     NUM_EXP_TRIALS = 18
 
@@ -563,28 +893,20 @@ class ComprehensionSwarmFullRenderer(SwarmAnaphorPilotRenderer):
                                      else "location"].capitalize() + "."
         ]
 
-        trial["prompt"] = " ".join([
-            "How", "many" if trial["agent_plural"] else "much",
-            trial["agent"],
-            "are" if trial["agent_plural"] else "is",
-            trial["prompt_preposition"],
-            trial["location_determiner"],
-            trial["location"]
-        ]) + "?"
+        trial["prompt"] = self.fill(self.get_skeleton(item)["prompt"])
 
         return trial
 
     def get_filler_trials(self, materials, num_trials: int):
-        empty_items = [item for item in materials["items"]
-                       if item["rating"] == "empty"]
-        full_items = [item for item in materials["items"]
-                      if item["rating"] == "full"]
+        pool = self.get_filler_pool(materials, "rating")
+        empty_items = pool.partition("empty")
+        full_items = pool.partition("full")
 
         # Sample an equal balance of "empty" and "full"
         num_empty = num_trials // 2
 
-        bad_trials = random.sample(empty_items, num_empty)
-        good_trials = random.sample(full_items, num_trials - num_empty)
+        bad_trials = self.random.sample(empty_items, num_empty)
+        good_trials = self.random.sample(full_items, num_trials - num_empty)
         all_trials = bad_trials + good_trials
 
         all_trials = [{
@@ -611,14 +933,15 @@ class ComprehensionSwarmFullRenderer(SwarmAnaphorPilotRenderer):
             (1, 1),  # given = a, subject = a
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
-@register_trial_renderer("09_comprehension_swarm-full-nonalternating-control")
+@register_trial_renderer("09_comprehension_swarm-full-nonalternating-control",
+                         materials=["swarm-006-nonalternating-natural",
+                                    "fillers/swarm_comprehension-000-base"])
 class ComprehensionSwarmFullWithNonAlternatingControlRenderer(
   ComprehensionSwarmFullRenderer):
 
@@ -627,30 +950,40 @@ class ComprehensionSwarmFullWithNonAlternatingControlRenderer(
         ["non alternating given A", "non alternating given A.P",
          "non alternating given L"]
 
-    def build_trial(self, item, condition, materials_id):
-        trial = super().build_trial(item, condition, materials_id)
-        agent_is_given, agent_is_subject = condition
-
-        p = functools.partial(self.process_field, item)
+    def build_skeleton(self, item):
+        skeleton = super().build_skeleton(item)
 
-        if agent_is_given:
-            trial["critical_clause"]["nonalternating"] = " ".join([
-                trial["agent_pronoun_subject"],
-                "are" if trial["agent_plural"] else "is",
+        # Nonalternating critical clauses when the agent is given / not given
+        skeleton["nonalternating_clause"] = {
+            True: FieldTemplate.join([
+                item["given A pron subj"],
+                "are" if item["A countable?"] else "is",
                 item["non alternating given A"],
                 item["non alternating given A.P"],
-                trial["location_determiner"],
-                trial["location"],
-            ])
-        else:
-            trial["critical_clause"]["nonalternating"] = " ".join([
-                p("non alternating given L.det")
+                compile_field(item["L det"]),
+                item["L"],
+            ], sep=" "),
+
+            False: FieldTemplate.join([
+                compile_field(item["non alternating given L.det"])
                     if item["non alternating given L.det"] else "",
-                trial["agent"],
-                "are" if trial["agent_plural"] else "is",
+                item["A"],
+                "are" if item["A countable?"] else "is",
                 item["non alternating given A"],
                 item["non alternating given L"],
-            ]).strip()
+            ], sep=" ").strip(),
+        }
+
+        return skeleton
+
+    def build_trial(self, item, condition, materials_id):
+        trial = super().build_trial(item, condition, materials_id)
+        agent_is_given, agent_is_subject = condition
+
+        nonalternating_clause = \
+            self.get_skeleton(item)["nonalternating_clause"][bool(agent_is_given)]
+        trial["critical_clause"]["nonalternating"] = \
+            self.fill(nonalternating_clause)
 
         trial["sentences"] = [
             trial["setup_clause"]["agent" if agent_is_given
@@ -666,14 +999,7 @@ class ComprehensionSwarmFullWithNonAlternatingControlRenderer(
             critical_clause = trial["critical_clause"]["nonalternating"]
         trial["sentences"].append(critical_clause.capitalize() + ".")
 
-        trial["prompt"] = " ".join([
-            "How", "many" if trial["agent_plural"] else "much",
-            trial["agent"],
-            "are" if trial["agent_plural"] else "is",
-            trial["prompt_preposition"],
-            trial["location_determiner"],
-            trial["location"]
-        ]) + "?"
+        trial["prompt"] = self.fill(self.get_skeleton(item)["prompt"])
 
         return trial
 
@@ -692,10 +1018,9 @@ class ComprehensionSwarmFullWithNonAlternatingControlRenderer(
             (1, 2),  # given = a, nonalternating
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
@@ -719,11 +1044,44 @@ class SprayLoadPilotRenderer(TrialRenderer):
         return items
 
     def _filter_and_sample_materials(self, materials):
-        items = self._filter_materials(materials)
-        items = random.sample(items, self.NUM_EXP_TRIALS)
+        pool = self.get_exp_pool(materials)
+        with stage("sampling"):
+            items = self.random.sample(pool.items, self.NUM_EXP_TRIALS)
 
         return items
 
+    def build_skeleton(self, item):
+        skeleton = super().build_skeleton(item)
+
+        theme = {"light": compile_field(item["T"]),
+                 "heavy": compile_field(item["T heavy"])}
+        location = {"light": compile_field(item["L"]),
+                    "heavy": compile_field(item["L heavy"])}
+
+        # Build all sentences for all possible conditions. They are identified
+        # in the output map by the concatenation of the int values of the
+        # condition tuple as a string, e.g. "010" for T is not object, L heavy,
+        # T not heavy.
+        all_conditions = itertools.product([0, 1], repeat=3)
+        skeleton["sentences"] = {}
+        for t_is_object, l_heavy, t_heavy in all_conditions:
+            key = f"{t_is_object}{l_heavy}{t_heavy}"
+
+            location_np = location["heavy" if l_heavy else "light"]
+            theme_np = theme["heavy" if t_heavy else "light"]
+            postverb = (
+                [theme_np, item["P"], location_np.strip(",")]
+                if t_is_object else
+                [location_np, "with", theme_np.strip(",")]
+            )
+
+            sentence = FieldTemplate.join(
+                [compile_field(item["S"]), item["V past simp"], *postverb],
+                sep=" ")
+            skeleton["sentences"][key] = FieldTemplate.join([sentence, "."])
+
+        return skeleton
+
     def build_trial(self, item, condition, materials_id):
         self._reset_var_cache()
 
@@ -763,35 +1121,18 @@ class SprayLoadPilotRenderer(TrialRenderer):
             "prompt_preposition": item["Prompt P"],
         }
 
-        # Build all sentences for all possible conditions. They are identified
-        # in the output map by the concatenation of the int values of the
-        # condition tuple as a string, e.g. "010" for T is not object, L heavy,
-        # T not heavy.
-        all_conditions = itertools.product([0, 1], repeat=3)
-        trial["sentences"] = {}
-        for t_is_object, l_heavy, t_heavy in all_conditions:
-            key = f"{t_is_object}{l_heavy}{t_heavy}"
-
-            location = trial["location"]["heavy" if l_heavy else "light"]
-            theme = trial["theme"]["heavy" if t_heavy else "light"]
-            postverb = " ".join(
-                [theme, trial["preposition"], location.strip(",")]
-                if t_is_object else
-                [location, "with", theme.strip(",")]
-            )
-
-            trial["sentences"][key] = " ".join([
-                trial["subject"],
-                trial["verb"]["past simp"],
-                postverb
-            ]) + "."
+        # Sentences for all possible conditions
+        trial["sentences"] = {
+            key: self.fill(sentence)
+            for key, sentence in self.get_skeleton(item)["sentences"].items()}
 
         # Add image paths if available.
         for image_key in ["image max", "image mid intention complete",
                           "image mid intention incomplete", "image min"]:
             if item.get(image_key) is not None:
                 dst = image_key[len("image "):].replace(" ", "_")
-                trial["images"][dst] = item[image_key]
+                trial["images"][dst] = self.image_path(materials_id,
+                                                       item[image_key])
 
         return trial
 
@@ -807,10 +1148,11 @@ class SprayLoadPilotRenderer(TrialRenderer):
         exp_trials = self.get_exp_trials(exp_materials)
 
         num_fillers = self.TOTAL_NUM_TRIALS - self.NUM_EXP_TRIALS
-        filler_trials = self.get_filler_trials(filler_materials, num_fillers)
+        with stage("fillers"):
+            filler_trials = self.get_filler_trials(filler_materials, num_fillers)
 
         trials = exp_trials + filler_trials
-        random.shuffle(trials)
+        self.random.shuffle(trials)
 
         ret = dict(experiment=self.experiment_name, materials_id=materials_id,
                    trials=trials)
@@ -818,44 +1160,63 @@ class SprayLoadPilotRenderer(TrialRenderer):
         return ret
 
 
-@register_trial_renderer("05_comprehension_spray-load-construction-meaning")
+@register_trial_renderer("05_comprehension_spray-load-construction-meaning",
+                         materials=["spray-load-002-indefinite",
+                                    "fillers/spray-load_comprehension-002-prompt"])
 class ComprehensionSprayLoadMeaningRenderer(SprayLoadPilotRenderer):
 
+    frontend_fields = ["materials_id", "item_id", "condition_id", "sentence",
+                       "prompt", "slider_labels"]
+
     TOTAL_NUM_TRIALS = 32
     NUM_EXP_TRIALS = 20
 
-    def build_trial(self, item, condition, materials_id):
-        trial = super().build_trial(item, condition, materials_id)
+    def build_skeleton(self, item):
+        skeleton = super().build_skeleton(item)
 
-        prompt = " ".join([
-            "How", "many" if trial["theme"]["is_plural"] else "much",
-            trial["theme"]["light"],
-            "are" if trial["theme"]["is_plural"] else "is",
-            trial["prompt_preposition"],
-            trial["location"]["light"],
-        ]) + "?"
+        location = compile_field(item["L"])
+        skeleton["prompt"] = FieldTemplate.join([
+            "How", "many" if item["T plural?"] else "much",
+            compile_field(item["T"]),
+            "are" if item["T plural?"] else "is",
+            item["Prompt P"],
+            FieldTemplate.join([location, "?"]),
+        ], sep=" ")
 
-        if trial["scale_type"] == "cover":
+        if item["scale type"] == "cover":
             slider_labels = [
                 "0% / none",
 
-                f"100% / {trial['location']['light']} "
-                f"{'are' if trial['location']['is_plural'] else 'is'} "
-                f"completely covered",
+                FieldTemplate.join([
+                    "100% /", location,
+                    "are" if item["L plural?"] else "is",
+                    "completely covered",
+                ], sep=" "),
             ]
-        elif trial["scale_type"] == "fill":
+        elif item["scale type"] == "fill":
             slider_labels = [
                 "0% / empty",
 
-                f"100% / {trial['location']['light']} "
-                f"{'are' if trial['location']['is_plural'] else 'is'} "
-                f"completely full",
+                FieldTemplate.join([
+                    "100% /", location,
+                    "are" if item["L plural?"] else "is",
+                    "completely full",
+                ], sep=" "),
             ]
         else:
-            raise ValueError("Unknown item scale type %s" % trial["scale_type"])
+            raise ValueError("Unknown item scale type %s" % item["scale type"])
+        skeleton["slider_labels"] = slider_labels
+
+        return skeleton
 
-        trial["prompt"] = prompt
-        trial["slider_labels"] = slider_labels
+    def build_trial(self, item, condition, materials_id):
+        trial = super().build_trial(item, condition, materials_id)
+
+        skeleton = self.get_skeleton(item)
+        trial["prompt"] = self.fill(skeleton["prompt"])
+        trial["slider_labels"] = [
+            label if isinstance(label, str) else self.fill(label)
+            for label in skeleton["slider_labels"]]
 
         sentence_key = "".join(map(str, condition))
         trial["sentence"] = trial["sentences"][sentence_key]
@@ -863,16 +1224,15 @@ class ComprehensionSprayLoadMeaningRenderer(SprayLoadPilotRenderer):
         return trial
 
     def get_filler_trials(self, materials, num_trials: int):
-        empty_items = [item for item in materials["items"]
-                       if item["rating"] == "empty"]
-        full_items = [item for item in materials["items"]
-                      if item["rating"] == "full"]
+        pool = self.get_filler_pool(materials, "rating")
+        empty_items = pool.partition("empty")
+        full_items = pool.partition("full")
 
         # Sample an equal balance of "empty" and "full"
         num_empty = num_trials // 2
 
-        bad_trials = random.sample(empty_items, num_empty)
-        good_trials = random.sample(full_items, num_trials - num_empty)
+        bad_trials = self.random.sample(empty_items, num_empty)
+        good_trials = self.random.sample(full_items, num_trials - num_empty)
         all_trials = bad_trials + good_trials
 
         all_trials = [{
@@ -901,16 +1261,20 @@ class ComprehensionSprayLoadMeaningRenderer(SprayLoadPilotRenderer):
             (1, 0, 0),  # object = T, L not heavy, T not heavy
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
-@register_trial_renderer("06_production_spray-load-weight")
+@register_trial_renderer("06_production_spray-load-weight",
+                         materials=["spray-load-002-indefinite",
+                                    "fillers/spray-load_production-000-base"])
 class ProductionSprayLoadWeightRenderer(SprayLoadPilotRenderer):
 
+    frontend_fields = ["materials_id", "item_id", "condition_id",
+                       "sentence_options"]
+
     TOTAL_NUM_TRIALS = 32
     NUM_EXP_TRIALS = 20
 
@@ -931,7 +1295,7 @@ class ProductionSprayLoadWeightRenderer(SprayLoadPilotRenderer):
         return trial
 
     def get_filler_trials(self, materials, num_trials: int):
-        trials = random.sample(materials["items"], num_trials)
+        trials = self.random.sample(self.get_filler_pool(materials).items, num_trials)
 
         def build_trial(t):
             self._reset_var_cache()
@@ -965,16 +1329,20 @@ class ProductionSprayLoadWeightRenderer(SprayLoadPilotRenderer):
             (None, 0, 1),
         ]
 
-        trial_conditions = random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
+        trial_conditions = self.random.choices(condition_choices, k=self.NUM_EXP_TRIALS)
 
-        trials = [self.build_trial(item, condition, materials["name"])
-                  for item, condition in zip(items, trial_conditions)]
+        trials = self.build_trials(items, trial_conditions, materials["name"])
         return trials
 
 
-@register_trial_renderer("07_comprehension_spray-load-construction-meaning-with-images")
+@register_trial_renderer("07_comprehension_spray-load-construction-meaning-with-images",
+                         materials=["spray-load-003-images",
+                                    "fillers/spray-load_comprehension-002-prompt"])
 class ComprehensionSprayLoadMeaningWithImagesRenderer(ComprehensionSprayLoadMeaningRenderer):
 
+    frontend_fields = ComprehensionSprayLoadMeaningRenderer.frontend_fields + \
+        ["measure", "images"]
+
     TOTAL_NUM_TRIALS = 32
     NUM_EXP_TRIALS = 20
 
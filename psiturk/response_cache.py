@@ -0,0 +1,114 @@
+"""
+In-process cache of serialized responses for deterministic (seeded) renders.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+from serialization import compress
+
+
+class CachedResponse(object):
+    """
+    Serialized response body, along with any compressed variants of it which
+    have been requested so far.
+    """
+
+    __slots__ = ("key", "materials", "body", "etag", "encoded")
+
+    def __init__(self, key, materials, body: bytes):
+        self.key = key
+        self.materials = materials
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+
+        # content encoding -> encoded body
+        self.encoded = {}
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(body) for body in self.encoded.values())
+
+
+class ResponseCache(object):
+    """
+    LRU cache of serialized responses, bounded by total body size.
+
+    Each entry remembers the materials it was rendered from, and is only
+    returned for lookups with those same materials objects. Entries for
+    materials which have since been reloaded are thus never served.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, materials):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or any(a is not b for a, b
+                                    in zip(entry.materials, materials)):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, materials, body: bytes) -> CachedResponse:
+        entry = CachedResponse(key, tuple(materials), body)
+
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._total_bytes -= old_entry.size
+
+            self._entries[key] = entry
+            self._total_bytes += entry.size
+            self._evict()
+
+        return entry
+
+    def _evict(self):
+        # NB called with the lock held
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= evicted.size
+
+    def encode(self, entry: CachedResponse, encoding: str) -> bytes:
+        """
+        Get the body of a cached response in the given content encoding,
+        compressing it only on first request.
+        """
+        try:
+            return entry.encoded[encoding]
+        except KeyError:
+            pass
+
+        encoded = compress(entry.body, encoding)
+        with self._lock:
+            if encoding not in entry.encoded:
+                entry.encoded[encoding] = encoded
+                # Only account for entries which haven't been evicted since.
+                if self._entries.get(entry.key) is entry:
+                    self._total_bytes += len(encoded)
+                    self._evict()
+
+        return encoded
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
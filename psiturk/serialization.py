@@ -0,0 +1,146 @@
+"""
+Fast JSON serialization and content-encoding of responses.
+
+The JSON encoder is pluggable: by default we use the fastest available of
+`orjson`, `simplejson` and the standard library `json`, which can be
+overridden with the `TRIALS_JSON_ENCODER` environment variable.
+"""
+
+import gzip
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+L = logging.getLogger(__name__)
+
+
+def _dumps_orjson(obj) -> bytes:
+    # NB some renderers produce dicts with int keys
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _dumps_simplejson(obj) -> bytes:
+    return simplejson.dumps(obj).encode("utf-8")
+
+
+def _dumps_json(obj) -> bytes:
+    return json.dumps(obj).encode("utf-8")
+
+
+JSON_ENCODERS = {}
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = _dumps_orjson
+if simplejson is not None:
+    JSON_ENCODERS["simplejson"] = _dumps_simplejson
+JSON_ENCODERS["json"] = _dumps_json
+
+
+def get_json_encoder(name=None):
+    """
+    Get a function serializing objects to JSON bytes. By default, the fastest
+    available encoder.
+    """
+    if name is None:
+        return next(iter(JSON_ENCODERS.values()))
+
+    try:
+        return JSON_ENCODERS[name]
+    except KeyError:
+        raise ValueError(f"JSON encoder {name} is not available. Available "
+                         f"encoders: {', '.join(JSON_ENCODERS)}")
+
+
+dumps = get_json_encoder(os.environ.get("TRIALS_JSON_ENCODER") or None)
+
+
+def to_columnar(trial_list, fields=None):
+    """
+    Convert a rendered trial list (as returned by `TrialRenderer.get_trials`)
+    into a compact columnar form, which names each field once:
+
+        {"experiment": ..., "materials_id": ..., "num_trials": n,
+         "fields": [field, ...], "columns": [[value, ...], ...],
+         "strings": [...], "interned": [column index, ...]}
+
+    Values in `interned` columns are indices into `strings`. Trials which
+    lack a field have a null value.
+
+    Args:
+        trial_list:
+        fields: Trial fields to include. By default, all fields of any trial.
+    """
+    trials = trial_list["trials"]
+    if fields is None:
+        fields = list(dict.fromkeys(key for trial in trials for key in trial))
+
+    strings = {}
+    columns = []
+    interned = []
+    for i, field in enumerate(fields):
+        column = [trial.get(field) for trial in trials]
+
+        # Intern string columns with repeated values
+        values = [value for value in column if value is not None]
+        if values and all(type(value) is str for value in values) \
+                and len(set(values)) < len(values):
+            column = [None if value is None
+                      else strings.setdefault(value, len(strings))
+                      for value in column]
+            interned.append(i)
+
+        columns.append(column)
+
+    return dict(experiment=trial_list["experiment"],
+                materials_id=trial_list["materials_id"],
+                num_trials=len(trials), fields=list(fields), columns=columns,
+                strings=list(strings), interned=interned)
+
+
+#####################
+
+
+# Don't bother compressing responses smaller than this many bytes.
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSORS = {"gzip": lambda body: gzip.compress(body, compresslevel=6)}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=5)
+
+# Supported content encodings, in order of preference.
+CONTENT_ENCODINGS = [encoding for encoding in ("br", "gzip")
+                     if encoding in COMPRESSORS]
+
+
+def choose_content_encoding(accept_encodings, body_size: int):
+    """
+    Pick the preferred content encoding accepted by a client, or `None` if the
+    response should be sent uncompressed.
+
+    Args:
+        accept_encodings: `request.accept_encodings`
+        body_size: Size in bytes of the uncompressed response.
+    """
+    if body_size < MIN_COMPRESS_SIZE:
+        return None
+
+    return accept_encodings.best_match(CONTENT_ENCODINGS)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    return COMPRESSORS[encoding](body)
@@ -0,0 +1,123 @@
+"""
+Persistent store of the trial list served to each participant, so that a
+participant who reloads the experiment gets the same list back rather than a
+freshly randomized one.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+
+
+L = logging.getLogger(__name__)
+
+
+class TrialListStore(object):
+    """
+    Serialized trial lists in a sqlite database, keyed by participant
+    `uniqueId`, experiment and materials ID.
+
+    Only the first list stored under each key is kept. Writes are handed to a
+    background thread, so requests never wait on disk; lists which are not
+    yet written are served from memory in the meantime.
+    """
+
+    def __init__(self, path="trial_lists.db"):
+        self.path = path
+
+        self._pending = {}
+        self._writes = queue.Queue()
+        self._lock = threading.Lock()
+        self._conn = None
+
+        self.hits = 0
+        self.misses = 0
+
+        self._writer = threading.Thread(target=self._run, daemon=True,
+                                        name="trial-store-writer")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS trial_lists (
+                            unique_id TEXT NOT NULL,
+                            experiment TEXT NOT NULL,
+                            materials_id TEXT NOT NULL,
+                            body BLOB NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            PRIMARY KEY (unique_id, experiment, materials_id))""")
+        conn.commit()
+        return conn
+
+    def start(self):
+        with self._lock:
+            self._conn = self._connect()
+        self._writer.start()
+        return self
+
+    def _lookup(self, key):
+        # NB caller holds `_lock`, which also guards the shared connection.
+        body = self._pending.get(key)
+        if body is None:
+            row = self._conn.execute(
+                "SELECT body FROM trial_lists WHERE unique_id = ? "
+                "AND experiment = ? AND materials_id = ?", key).fetchone()
+            body = row[0] if row is not None else None
+        return body
+
+    def get(self, unique_id, experiment, materials_id):
+        """
+        Get the serialized trial list stored for a participant, or `None`.
+        """
+        key = (unique_id, experiment, ",".join(materials_id))
+        with self._lock:
+            body = self._lookup(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return body
+
+    def put(self, unique_id, experiment, materials_id, body: bytes) -> bytes:
+        """
+        Store a participant's serialized trial list, unless one is already
+        stored for them.
+
+        Returns:
+            The stored trial list, which is `body` unless another list was
+            stored first (e.g. by a concurrent request).
+        """
+        key = (unique_id, experiment, ",".join(materials_id))
+        with self._lock:
+            stored = self._lookup(key)
+            if stored is not None:
+                return stored
+            self._pending[key] = body
+
+        self._writes.put((key, body))
+        return body
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            key, body = self._writes.get()
+            try:
+                with conn:
+                    conn.execute("INSERT OR IGNORE INTO trial_lists "
+                                 "(unique_id, experiment, materials_id, body) "
+                                 "VALUES (?, ?, ?, ?)", key + (body,))
+            except sqlite3.Error:
+                L.exception("failed to store trial list for %s", key)
+                continue
+
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
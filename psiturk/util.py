@@ -1,21 +1,172 @@
+from array import array
+from bisect import bisect_right
 import random
+import threading
 
 import names
 
 
-def random_name(gender=None):
+class _NameTable(object):
+    """
+    First names of one gender with their cumulative frequencies (in percent),
+    as listed in a `names` distribution file.
+    """
+
+    __slots__ = ("names", "cumulative", "index")
+
+    # `names` draws uniformly from this range of cumulative frequencies.
+    # Names beyond it are never drawn.
+    MAX_CUMULATIVE = 90.0
+
+    def __init__(self, path):
+        self.names = []
+        self.cumulative = array("d")
+        with open(path) as name_file:
+            for line in name_file:
+                name, _, cumulative, _ = line.split()
+                if self.cumulative and self.cumulative[-1] >= self.MAX_CUMULATIVE:
+                    break
+
+                self.names.append(name.capitalize())
+                self.cumulative.append(min(float(cumulative), self.MAX_CUMULATIVE))
+
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    @property
+    def total(self):
+        return self.cumulative[-1] if self.cumulative else 0.0
+
+    def _start(self, i):
+        return self.cumulative[i - 1] if i > 0 else 0.0
+
+    def mass(self, exclude=()) -> float:
+        """
+        Total frequency of all names except those at the given indices.
+        """
+        return self.total - sum(self.cumulative[i] - self._start(i)
+                                for i in exclude)
+
+    def draw(self, rng, exclude=()) -> str:
+        """
+        Draw a name by its frequency, excluding the names at the given
+        indices. Without exclusions, this draws exactly as
+        `names.get_first_name` does from the same random state.
+        """
+        if not self.names:
+            return ""
+
+        excluded = sorted(exclude)
+        selected = rng.random() * self.mass(excluded)
+
+        # Skip over the probability mass of excluded names
+        for i in excluded:
+            if self._start(i) > selected:
+                break
+            selected += self.cumulative[i] - self._start(i)
+
+        i = min(bisect_right(self.cumulative, selected), len(self.names) - 1)
+        if excluded and i in excluded:
+            # Only possible through rounding at interval boundaries
+            i = next((j for j in range(len(self.names)) if j not in excluded), i)
+        return self.names[i]
+
+
+class NameSampler(object):
+    """
+    Draws random first names by their US census frequency, from tables loaded
+    into memory once per gender rather than read from disk on every draw.
+    """
+
+    GENDERS = ("male", "female")
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _table(self, gender) -> _NameTable:
+        try:
+            return self._tables[gender]
+        except KeyError:
+            with self._lock:
+                if gender not in self._tables:
+                    self._tables[gender] = _NameTable(names.FILES[f"first:{gender}"])
+                return self._tables[gender]
+
+    def draw(self, gender=None, rng=random, exclude=()):
+        """
+        Draw a random first name (with balanced gender unless specified).
+
+        Args:
+            gender: "male" or "female"
+            rng: `random.Random` instance used for all random draws
+            exclude: Names which must not be drawn.
+
+        Returns:
+            Tuple `(name, gender)`
+        """
+        if gender is None:
+            if exclude:
+                # Pick each gender in proportion to its remaining share of
+                # names, so that draws are distributed exactly as when
+                # rejection-sampling names which are not excluded.
+                shares = []
+                for gender in self.GENDERS:
+                    table = self._table(gender)
+                    shares.append(table.mass(self._indices(table, exclude))
+                                  / table.total if table.total else 0.0)
+                gender = rng.choices(self.GENDERS, weights=shares)[0]
+            else:
+                gender = rng.choice(self.GENDERS)
+
+        table = self._table(gender)
+        return table.draw(rng, self._indices(table, exclude)), gender
+
+    @staticmethod
+    def _indices(table: _NameTable, names):
+        return [table.index[name] for name in names if name in table.index]
+
+    def draw_distinct(self, k: int, rng=random, genders=None, exclude=()):
+        """
+        Draw `k` distinct first names, with genders balanced as evenly as
+        possible (in random order) unless specified.
+
+        Args:
+            k:
+            rng: `random.Random` instance used for all random draws
+            genders: Optional gender of each name to draw.
+            exclude: Names which must not be drawn.
+
+        Returns:
+            List of `(name, gender)` tuples
+        """
+        if genders is None:
+            genders = list(self.GENDERS) * (k // 2)
+            if k % 2:
+                genders.append(rng.choice(self.GENDERS))
+            rng.shuffle(genders)
+
+        drawn = []
+        exclude = set(exclude)
+        for gender in genders:
+            name, _ = self.draw(gender, rng=rng, exclude=exclude)
+            exclude.add(name)
+            drawn.append((name, gender))
+
+        return drawn
+
+
+NAMES = NameSampler()
+
+
+def random_name(gender=None, rng=random):
     """
     Draw a random first name (with balanced gender unless specified).
 
     Args:
         gender: "male" or "female"
+        rng: `random.Random` instance used for all random draws
 
     Returns:
         Tuple `(name, gender)`
     """
-
-    if gender is None:
-        gender = random.choice(("male", "female"))
-
-    name = names.get_first_name(gender)
-    return name, gender
+    return NAMES.draw(gender, rng=rng)
@@ -0,0 +1,78 @@
+"""
+Startup warmup, which pays the lazy costs of serving trials (materials
+parsing, pool compilation, name tables, regex compilation, serialization)
+before the first participant arrives.
+"""
+
+import logging
+import time
+
+from renderers import TRIAL_RENDERERS, EXPERIMENT_MATERIALS, render_trials
+import serialization
+
+
+L = logging.getLogger(__name__)
+
+
+def warm_up(load_materials, experiments=None):
+    """
+    Load materials for the given experiments, build each renderer's compiled
+    state, and render and serialize one throwaway trial list per experiment.
+
+    Experiments whose materials cannot be loaded are skipped.
+
+    Args:
+        load_materials: Function mapping a materials ID to parsed materials,
+            e.g. `MaterialsCache.get`.
+        experiments: Names of experiments to warm up. By default, all
+            registered experiments.
+
+    Returns:
+        Dict mapping each warmed-up experiment to a dict of stage timings in
+        seconds.
+    """
+    if experiments is None:
+        experiments = sorted(TRIAL_RENDERERS)
+
+    timings = {}
+    for experiment in experiments:
+        if experiment not in TRIAL_RENDERERS:
+            L.warning("warmup: no trial renderer for experiment %s", experiment)
+            continue
+
+        materials_id = list(EXPERIMENT_MATERIALS[experiment])
+        experiment_timings = {}
+
+        start = time.perf_counter()
+        try:
+            materials = tuple(load_materials(id) for id in materials_id)
+        except ValueError as exc:
+            L.warning("warmup: skipping %s, %s", experiment, exc.args[0])
+            continue
+        experiment_timings["materials"] = time.perf_counter() - start
+
+        try:
+            start = time.perf_counter()
+            renderer = TRIAL_RENDERERS[experiment](experiment)
+            renderer.get_exp_pool(materials[0])
+            experiment_timings["compile"] = time.perf_counter() - start
+
+            # NB also compiles filler pools, which depend on each renderer's
+            # sampling scheme.
+            start = time.perf_counter()
+            trials = render_trials(experiment, materials, materials_id)
+            experiment_timings["render"] = time.perf_counter() - start
+        except Exception:
+            L.exception("warmup: failed to render trials for %s", experiment)
+            continue
+
+        start = time.perf_counter()
+        serialization.dumps(trials)
+        experiment_timings["serialize"] = time.perf_counter() - start
+
+        timings[experiment] = experiment_timings
+        L.info("warmup: %s ready (%s)", experiment,
+               ", ".join(f"{stage} {seconds * 1000:.1f}ms"
+                         for stage, seconds in experiment_timings.items()))
+
+    return timings
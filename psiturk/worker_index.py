@@ -0,0 +1,148 @@
+"""
+Persistent index of the workers who took part in any of several experiments,
+each with its own psiturk participant database, so that repeat participants
+can be screened with an indexed lookup rather than by scanning all data.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+
+L = logging.getLogger(__name__)
+
+
+class WorkerIndex(object):
+    """
+    Index of participations by workerId, kept in a sqlite database and
+    updated incrementally from each source database's new participants by a
+    background thread.
+    """
+
+    def __init__(self, sources, path="/data/worker_index.db",
+                 table_name="turkdemo", update_interval=10.0):
+        """
+        Args:
+            sources: Dict mapping a source name (e.g. experiment) to the path
+                of its sqlite participant database.
+            path: Path of the index database.
+            table_name: Name of psiturk's participant table in each source.
+            update_interval: Seconds between background updates from
+                sources.
+        """
+        self.sources = dict(sources)
+        self.path = path
+        self.table_name = table_name
+        self.update_interval = update_interval
+
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def start(self):
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS participations (
+                    worker_id TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    unique_id TEXT NOT NULL,
+                    codeversion TEXT,
+                    beginhit TIMESTAMP,
+                    PRIMARY KEY (source, unique_id));
+                CREATE INDEX IF NOT EXISTS participations_worker_id
+                    ON participations (worker_id);
+                CREATE TABLE IF NOT EXISTS sources (
+                    source TEXT PRIMARY KEY,
+                    last_beginhit TIMESTAMP);
+            """)
+            self._conn.commit()
+
+        threading.Thread(target=self._run, daemon=True,
+                         name="worker-index").start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.update()
+            except Exception:
+                L.exception("failed to update worker index")
+            time.sleep(self.update_interval)
+
+    def update(self):
+        """
+        Index participants added to each source since its last update.
+
+        Returns:
+            Number of newly indexed participations.
+        """
+        num_added = 0
+        with self._lock:
+            for source, db_path in self.sources.items():
+                try:
+                    num_added += self._update_source(source, db_path)
+                except sqlite3.Error:
+                    L.exception("failed to index workers from %s", db_path)
+
+        return num_added
+
+    def _update_source(self, source, db_path):
+        row = self._conn.execute(
+            "SELECT last_beginhit FROM sources WHERE source = ?",
+            (source,)).fetchone()
+        since = row[0] if row is not None else None
+
+        # NB participants who began at the previous watermark are fetched
+        # again, and ignored by the primary key.
+        source_conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            rows = source_conn.execute(
+                f"SELECT workerid, uniqueid, codeversion, beginhit "
+                f"FROM {self.table_name} WHERE workerid IS NOT NULL "
+                f"AND (? IS NULL OR beginhit >= ?)",
+                (since, since)).fetchall()
+        finally:
+            source_conn.close()
+
+        if not rows:
+            return 0
+
+        with self._conn:
+            num_before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO participations (worker_id, source, "
+                "unique_id, codeversion, beginhit) VALUES (?, ?, ?, ?, ?)",
+                [(worker_id, source, unique_id, codeversion, beginhit)
+                 for worker_id, unique_id, codeversion, beginhit in rows])
+            num_added = self._conn.total_changes - num_before
+
+            beginhits = [beginhit for *_, beginhit in rows if beginhit is not None]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sources (source, last_beginhit) "
+                "VALUES (?, ?)", (source, max(beginhits) if beginhits else since))
+
+        return num_added
+
+    def lookup(self, worker_id: str):
+        """
+        Get all indexed participations of a worker.
+
+        Returns:
+            List of dicts with keys `source`, `unique_id`, `codeversion` and
+            `beginhit`, in order of `beginhit`.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source, unique_id, codeversion, beginhit "
+                "FROM participations WHERE worker_id = ? ORDER BY beginhit",
+                (worker_id,)).fetchall()
+
+        return [dict(source=source, unique_id=unique_id,
+                     codeversion=codeversion, beginhit=beginhit)
+                for source, unique_id, codeversion, beginhit in rows]
+
+    def has_participated(self, worker_id: str, exclude_sources=()) -> bool:
+        return any(participation["source"] not in exclude_sources
+                   for participation in self.lookup(worker_id))
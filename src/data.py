@@ -5,6 +5,7 @@ Utilities for loading and preprocessing Psiturk experimental data.
 from copy import copy
 import json
 import logging
+import os
 import sqlite3
 
 import pandas as pd
@@ -26,16 +27,20 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+# sqlite connections can't be shared across processes, so reconnect when
+# called from a forked child.
 def _get_connection(db_path):
-    if not hasattr(_get_connection, "conn"):
+    if getattr(_get_connection, "pid", None) != os.getpid():
         _get_connection.conn = sqlite3.connect(db_path)
         _get_connection.conn.row_factory = dict_factory
+        _get_connection.pid = os.getpid()
         
     return _get_connection.conn
 
 def c():
-    if not hasattr(c, "cur"):
+    if getattr(c, "pid", None) != os.getpid():
         c.cur = _get_connection(PSITURK_DB_PATH).cursor()
+        c.pid = os.getpid()
     return c.cur
 
 def load_raw_results():
@@ -1,26 +1,79 @@
 import argparse
 import csv
+import hashlib
 import json
+import os
 from pathlib import Path
 
 import pandas as pd
 
 
+# Layout of the content-addressed materials store. See
+# `psiturk/materials_cache.py`.
+ALIASES_FILE = "aliases.json"
+OBJECTS_DIR = "objects"
+
+
+def _write_atomic(path, data: bytes):
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def publish(materials, store, alias):
+    """
+    Publish materials to a content-addressed store, and point `alias` at
+    them. Returns the content hash of the materials.
+    """
+    store = Path(store)
+    data = json.dumps(materials, sort_keys=True).encode("utf-8")
+    content_id = hashlib.sha256(data).hexdigest()
+
+    # Stored materials are immutable, so an existing object is never
+    # rewritten.
+    object_path = store / OBJECTS_DIR / content_id[:2] / f"{content_id}.json"
+    if not object_path.exists():
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomic(object_path, data)
+
+    aliases_path = store / ALIASES_FILE
+    aliases = {}
+    if aliases_path.exists():
+        with aliases_path.open() as f:
+            aliases = json.load(f)
+    aliases[alias] = content_id
+    _write_atomic(aliases_path,
+                  json.dumps(aliases, indent=2, sort_keys=True).encode("utf-8"))
+
+    return content_id
+
+
 def main(args):
     path = Path(args.csv)
-    ret = {"name": str(path.parent / path.stem)}
-    items = []
+    if path.suffix == ".json":
+        # Already converted materials, e.g. to migrate them into the store
+        with path.open() as f:
+            ret = json.load(f)
+    else:
+        ret = {"name": str(path.parent / path.stem)}
+        items = []
+
+        materials_df = pd.read_csv(path)
 
-    materials_df = pd.read_csv(path)
+        # NaN -> None for strict JSON compatibility
+        materials_df = materials_df.replace({float('nan'): None})
 
-    # NaN -> None for strict JSON compatibility
-    materials_df = materials_df.replace({float('nan'): None})
+        for idx, row in enumerate(materials_df.to_dict(orient="records")):
+            row["id"] = idx
+            items.append(row)
 
-    for idx, row in enumerate(materials_df.to_dict(orient="records")):
-        row["id"] = idx
-        items.append(row)
+        ret["items"] = items
 
-    ret["items"] = items
+    if args.store:
+        content_id = publish(ret, args.store, args.alias or ret["name"])
+        print(f"{args.alias or ret['name']} -> {content_id}")
+        return
 
     outf = args.outf or Path(args.csv).with_suffix(".json")
     with open(outf, "w") as f:
@@ -30,7 +83,15 @@ def main(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("csv")
+    parser.add_argument("csv", help="materials CSV, or already converted "
+                                    "materials JSON to publish to a store")
     parser.add_argument("-o", "--outf")
+    parser.add_argument("-s", "--store",
+                        help="publish to the content-addressed materials "
+                             "store at this path (e.g. /materials) rather "
+                             "than writing a JSON file")
+    parser.add_argument("-a", "--alias",
+                        help="materials ID to point at the published "
+                             "materials. Default: the materials name")
 
     main(parser.parse_args())
@@ -0,0 +1,111 @@
+"""
+Tests of admission control under concurrent load, in `psiturk/admission.py`.
+"""
+
+from pathlib import Path
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "psiturk"))
+from admission import AdmissionController, LoopLagMonitor
+
+
+def busy(seconds):
+    # A render, which never yields
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_rejects_beyond_queue():
+    admission = AdmissionController(max_concurrent=2, max_queued=2,
+                                    queue_timeout=5.0)
+    results = []
+
+    def handle():
+        admitted = admission.acquire()
+        results.append(admitted)
+        if admitted:
+            time.sleep(0.2)
+            admission.release()
+
+    threads = [threading.Thread(target=handle) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 4
+    assert results.count(False) == 6
+    assert admission.stats()["rejected"] == 6
+
+
+def test_rejects_while_loop_lags():
+    # Make thread switches cooperative, as under gevent: a thread which
+    # doesn't block holds up all others.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(10.0)
+    try:
+        admission = AdmissionController(
+            max_concurrent=50, max_queued=200, max_loop_lag=0.2,
+            loop_lag=LoopLagMonitor(interval=0.1)).start()
+        time.sleep(0.05)
+        assert admission.acquire()
+        admission.release()
+
+        arrived = threading.Event()
+        results = []
+
+        def handle():
+            arrived.wait()
+            admitted = admission.acquire()
+            results.append(admitted)
+            if admitted:
+                admission.release()
+
+        threads = [threading.Thread(target=handle) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+
+        # Requests arrive during a render, and are only handled after it
+        arrived.set()
+        busy(0.5)
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    assert results == [False] * 10
+    assert admission.stats()["rejected"] == 10
+
+
+def test_rejects_while_loop_lags_gevent():
+    gevent = pytest.importorskip("gevent")
+
+    loop_lag = LoopLagMonitor(interval=0.1, sleep=gevent.sleep)
+    admission = AdmissionController(max_concurrent=50, max_queued=200,
+                                    max_loop_lag=0.2, loop_lag=loop_lag)
+    monitor = gevent.spawn(loop_lag.run)
+    gevent.sleep(0.05)
+
+    def handle():
+        if not admission.acquire():
+            return 503
+        try:
+            busy(0.1)
+            return 200
+        finally:
+            admission.release()
+
+    try:
+        requests = [gevent.spawn(handle) for _ in range(20)]
+        gevent.joinall(requests)
+    finally:
+        monitor.kill()
+
+    statuses = [request.value for request in requests]
+    assert 200 in statuses
+    assert 503 in statuses
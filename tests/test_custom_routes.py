@@ -0,0 +1,152 @@
+"""
+Tests of the custom routes in `psiturk/custom.py`, run with Flask's test
+client. These need the psiturk server environment (psiturk, Flask).
+"""
+
+import io
+from pathlib import Path
+import tarfile
+
+import pytest
+
+flask = pytest.importorskip("flask")
+pytest.importorskip("psiturk")
+
+
+PSITURK_DIR = Path(__file__).resolve().parent.parent / "psiturk"
+
+IMAGE_PATH = "items/0_max.jpg"
+IMAGE_BYTES = b"\xff\xd8\xff\xe0 not really a jpeg"
+
+# Decodable image, for derivatives (if Pillow is available)
+PNG_IMAGE_PATH = "items/1_max.png"
+
+
+@pytest.fixture(scope="module")
+def custom(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("custom")
+    images_root = tmp_path / "images"
+    (images_root / IMAGE_PATH).parent.mkdir(parents=True)
+    (images_root / IMAGE_PATH).write_bytes(IMAGE_BYTES)
+    try:
+        from PIL import Image
+    except ImportError:
+        pass
+    else:
+        Image.new("RGB", (40, 20), "red").save(images_root / PNG_IMAGE_PATH)
+
+    env = pytest.MonkeyPatch()
+    env.setenv("IMAGES_ROOT", str(images_root))
+    env.setenv("IMAGE_DERIVATIVES_ROOT", str(tmp_path / "image_derivatives"))
+    env.setenv("PSITURK_DATABASE_URL", f"sqlite:///{tmp_path / 'participants.db'}")
+    env.setenv("TRIALS_STORE_PATH", "")
+    env.setenv("WORKER_INDEX_PATH", str(tmp_path / "worker_index.db"))
+    env.setenv("MATERIALS_WATCH", "0")
+    env.setenv("PSITURK_LOGIN_USERNAME", "admin")
+    env.setenv("PSITURK_LOGIN_PW", "secret")
+    env.setenv("PSITURK_SECRET_KEY", "test secret key")
+    env.setenv("WARMUP", "0")
+
+    # custom.py is loaded by psiturk from its own directory
+    env.chdir(PSITURK_DIR)
+    env.syspath_prepend(str(PSITURK_DIR))
+    import custom
+
+    yield custom
+    env.undo()
+
+
+@pytest.fixture
+def client(custom):
+    app = flask.Flask(__name__)
+    app.register_blueprint(custom.custom_code)
+    return app.test_client()
+
+
+def test_manifest_image(custom, client):
+    info = custom.image_manifest.get(IMAGE_PATH)
+
+    response = client.get(f"/images/{IMAGE_PATH}")
+    assert response.status_code == 200
+    assert response.data == IMAGE_BYTES
+    assert response.headers["ETag"] == f'"{info.hash}"'
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    # Revalidation by content hash
+    response = client.get(f"/images/{IMAGE_PATH}",
+                          headers={"If-None-Match": f'"{info.hash}"'})
+    assert response.status_code == 304
+
+
+def test_versioned_manifest_image(custom, client):
+    info = custom.image_manifest.get(IMAGE_PATH)
+
+    response = client.get(f"/images/{IMAGE_PATH}?v={info.hash}")
+    assert response.status_code == 200
+    assert "immutable" in response.headers["Cache-Control"]
+
+
+@pytest.mark.parametrize("data", [
+    {"images": [1]},
+    {"images": IMAGE_PATH},
+    {"trials": ["not a trial"]},
+    {"trials": [{"materials_id": "items", "images": ["0_max.jpg"]}]},
+    {"trials": [{"materials_id": 1, "images": {"max": "0_max.jpg"}}]},
+    {"images": [IMAGE_PATH], "format": ["webp"]},
+])
+def test_malformed_image_bundle(client, data):
+    response = client.post("/images/bundle", json=data)
+    assert response.status_code == 400
+
+
+def test_image_bundle(client):
+    response = client.post("/images/bundle", json={"images": [IMAGE_PATH]})
+    assert response.status_code == 200
+
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+        assert tar.extractfile(IMAGE_PATH).read() == IMAGE_BYTES
+
+
+def test_instrumented_counts_errors(custom):
+    @custom.instrumented("failing")
+    def view():
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        view()
+
+    rendered = custom.metrics.render([])
+    assert 'custom_requests_total{route="failing",status="500"} 1' in rendered
+    assert 'custom_request_seconds_count{route="failing"} 1' in rendered
+
+
+def test_image_derivative(custom, client):
+    pytest.importorskip("PIL")
+
+    response = client.get(f"/images/{PNG_IMAGE_PATH}?w=320&format=webp")
+    assert response.status_code == 200
+    assert response.data[8:12] == b"WEBP"
+
+    etag = response.headers["ETag"]
+    response = client.get(f"/images/{PNG_IMAGE_PATH}?w=320&format=webp",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_stats_requires_auth(client):
+    assert client.get("/stats").status_code == 401
+
+
+def test_protected_routes_disabled_without_credentials(custom, client,
+                                                       monkeypatch):
+    monkeypatch.setattr(custom, "myauth", None)
+    assert client.get("/stats").status_code == 404
+    assert client.get("/workers/A1B2C3").status_code == 404
+
+
+def test_worker_lookup_requires_auth(client):
+    assert client.get("/workers/A1B2C3").status_code == 401
+
+
+def test_trials_batch_requires_auth(client):
+    assert client.get("/trials/x/batch?n=2").status_code == 401
@@ -0,0 +1,42 @@
+"""
+Pre-generates resized and re-encoded variants of all materials images, so
+that the server never has to generate them while participants wait.
+
+Widths and the derivatives directory should match the server's
+`IMAGE_DERIVATIVE_WIDTHS` and `IMAGE_DERIVATIVES_ROOT`.
+"""
+
+from argparse import ArgumentParser
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent / "psiturk"))
+
+from images import DERIVATIVE_FORMATS, DerivativeCache, ImageManifest
+
+
+def main(args):
+    manifest = ImageManifest(args.images_root).scan()
+    derivatives = DerivativeCache(
+        manifest, args.derivatives_root,
+        widths=[int(width) for width in args.widths.split(",")])
+    if not derivatives.available:
+        sys.exit("Pillow is required to generate image derivatives.")
+
+    formats = [None if format == "source" else format
+               for format in args.formats.split(",")]
+    num_generated = derivatives.generate_all(formats)
+    print(f"Generated {num_generated} derivatives of {len(manifest.images)} images.")
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+
+    p.add_argument("-i", "--images_root", default="/materials/images")
+    p.add_argument("-d", "--derivatives_root", default="/data/image_derivatives")
+    p.add_argument("-w", "--widths", default="320,640,1024",
+                   help="comma-separated widths in pixels")
+    p.add_argument("-f", "--formats", default="source,webp",
+                   help="comma-separated formats, of: source, "
+                        + ", ".join(DERIVATIVE_FORMATS))
+
+    main(p.parse_args())
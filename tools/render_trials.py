@@ -0,0 +1,40 @@
+"""
+Renders the trial list served to a participant, given the seed used by the
+server (their `uniqueId` when `TRIALS_SEED_FROM_UNIQUEID` is set).
+
+The materials must be the same version as those the server rendered from.
+"""
+
+from argparse import ArgumentParser
+import json
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent / "psiturk"))
+
+from materials_cache import MaterialsCache
+from renderers import EXPERIMENT_MATERIALS, render_trials
+
+
+def main(args):
+    cache = MaterialsCache(args.materials_root)
+
+    materials_id = args.materials.split(",") if args.materials \
+        else list(EXPERIMENT_MATERIALS[args.experiment])
+    materials = tuple(cache.get(id) for id in materials_id)
+
+    trials = render_trials(args.experiment, materials, materials_id,
+                           seed=args.seed)
+    json.dump(trials, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+
+    p.add_argument("experiment")
+    p.add_argument("seed")
+    p.add_argument("--materials",
+                   help="comma-separated materials IDs. By default, those "
+                        "requested by the experiment's frontend.")
+    p.add_argument("-m", "--materials_root", default="/materials")
+
+    main(p.parse_args())
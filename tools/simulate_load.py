@@ -0,0 +1,237 @@
+"""
+Simulates concurrent participants against a psiturk server, and reports
+throughput, latency and the concurrency at which the server saturates.
+
+By default a local server is started from the `psiturk` directory, backed by
+a throwaway sqlite database, trial list store and worker index. Each
+synthetic participant starts a debug session, fetches trials for every
+registered experiment along with the images they reference, and syncs its
+data back to the server.
+
+With `--url`, participants are simulated against a running server instead.
+This creates debug participants (and stored trial lists) in that server's
+database, so it must be confirmed with `--allow_writes`.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import uuid
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+PSITURK_DIR = Path(__file__).resolve().parent.parent / "psiturk"
+sys.path.append(str(PSITURK_DIR))
+
+from renderers import TRIAL_RENDERERS, EXPERIMENT_MATERIALS
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class LoadStats(object):
+    """
+    Request latencies and failures, grouped by request kind.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+
+    def request(self, kind, url, data=None, method=None, timeout=60):
+        request = Request(url, data=data, method=method,
+                          headers={"Content-Type": "application/json"} if data else {})
+        start = time.perf_counter()
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                body = response.read()
+        except (HTTPError, URLError, OSError):
+            with self._lock:
+                self.failures[kind] += 1
+            return None
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies[kind].append(elapsed)
+        return body
+
+    @property
+    def num_requests(self):
+        return sum(len(latencies) for latencies in self.latencies.values()) \
+            + sum(self.failures.values())
+
+
+def run_participant(base_url, participant_id, experiments, stats):
+    """
+    Args:
+        participant_id: ID of the participant, unique across runs, so that
+            participants never get trial lists stored in previous runs.
+    """
+    worker_id = f"simworker{participant_id}"
+    assignment_id = f"simassignment{participant_id}"
+    unique_id = f"{worker_id}:{assignment_id}"
+
+    # Create the participant record, as when a worker accepts the HIT.
+    stats.request("exp", f"{base_url}/exp?" + urlencode({
+        "hitId": "simhit", "assignmentId": assignment_id,
+        "workerId": worker_id, "mode": "debug"}))
+
+    data = []
+    for experiment in experiments:
+        materials_id = EXPERIMENT_MATERIALS[experiment]
+        body = stats.request("trials", f"{base_url}/trials/{experiment}?" + urlencode({
+            "uniqueId": unique_id, "materials": ",".join(materials_id)}))
+        if body is None:
+            continue
+
+        trials = json.loads(body)["trials"]
+        for trial in trials:
+            for image in (trial.get("images") or {}).values():
+                if image is not None:
+                    stats.request("images",
+                                  f"{base_url}/images/{trial['materials_id']}/{image}")
+
+        data.extend({"trialdata": {"experiment_id": experiment,
+                                   "item_id": trial["item_id"]}}
+                    for trial in trials)
+
+        stats.request("sync", f"{base_url}/sync/{unique_id}", method="PUT",
+                      data=json.dumps({"uniqueid": unique_id, "data": data})
+                      .encode("utf-8"))
+
+
+def run_level(base_url, concurrency, num_participants, experiments, counter,
+              run_id):
+    stats = LoadStats()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(
+            lambda _: run_participant(base_url, f"{run_id}-{next(counter)}",
+                                      experiments, stats),
+            range(num_participants)))
+    elapsed = time.perf_counter() - start
+
+    return stats, elapsed
+
+
+def start_server(port, data_dir: Path):
+    # Keep the server from writing to (or serving from) persistent state
+    env = dict(os.environ,
+               PSITURK_DATABASE_URL=f"sqlite:///{data_dir / 'participants.db'}",
+               PSITURK_PORT=str(port),
+               PSITURK_HOST="127.0.0.1",
+               TRIALS_STORE_PATH=str(data_dir / "trial_lists.db"),
+               WORKER_INDEX_PATH=str(data_dir / "worker_index.db"))
+    server = subprocess.Popen(["psiturk-server"], cwd=PSITURK_DIR, env=env)
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(120):
+        try:
+            urlopen(base_url, timeout=1).read()
+            return server, base_url
+        except HTTPError:
+            # Any response means the server is up.
+            return server, base_url
+        except (URLError, OSError):
+            if server.poll() is not None:
+                raise RuntimeError("psiturk server exited during startup")
+            time.sleep(0.5)
+
+    server.terminate()
+    raise RuntimeError("psiturk server did not start in time")
+
+
+def main(args):
+    if args.url is not None and not args.allow_writes:
+        sys.exit("Simulating participants against --url creates debug "
+                 "participants in that server's database. Pass --allow_writes "
+                 "to confirm.")
+
+    experiments = args.experiments or sorted(TRIAL_RENDERERS)
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    server = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.url is None:
+            server, base_url = start_server(args.port, Path(tmp_dir))
+        else:
+            base_url = args.url.rstrip("/")
+
+        try:
+            # NB participants of each run are new to the server, even when
+            # it's a long-running server with a trial list store.
+            run_id = uuid.uuid4().hex[:8]
+            counter = itertools.count()
+            results = []
+            for concurrency in levels:
+                num_participants = max(concurrency, args.participants)
+                stats, elapsed = run_level(base_url, concurrency, num_participants,
+                                           experiments, counter, run_id)
+                results.append((concurrency, stats, elapsed))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    print(f"{'conc':>5} {'req/s':>8} {'trials p50':>11} {'trials p99':>11} "
+          f"{'all p50':>8} {'all p99':>8} {'failed':>7}")
+    saturation = None
+    best_throughput = 0
+    for concurrency, stats, elapsed in results:
+        throughput = stats.num_requests / elapsed
+        all_latencies = list(itertools.chain(*stats.latencies.values()))
+        print(f"{concurrency:>5} {throughput:>8.1f} "
+              f"{percentile(stats.latencies['trials'], 0.5) * 1000:>9.1f}ms "
+              f"{percentile(stats.latencies['trials'], 0.99) * 1000:>9.1f}ms "
+              f"{percentile(all_latencies, 0.5) * 1000:>6.1f}ms "
+              f"{percentile(all_latencies, 0.99) * 1000:>6.1f}ms "
+              f"{sum(stats.failures.values()):>7}")
+
+        # The server is saturated once more concurrency no longer buys
+        # meaningfully more throughput.
+        if saturation is None and best_throughput \
+                and throughput < best_throughput * (1 + args.saturation_gain):
+            saturation = concurrency
+        best_throughput = max(best_throughput, throughput)
+
+    if saturation is None:
+        print("Server did not saturate at the tested concurrency levels.")
+    else:
+        print(f"Server saturates at about {saturation} concurrent participants.")
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+
+    p.add_argument("--url", help="URL of a running server. By default, start "
+                                 "a local server with a throwaway database.")
+    p.add_argument("--allow_writes", action="store_true",
+                   help="confirm that simulated participants may be written "
+                        "to the database of the server at --url")
+    p.add_argument("--port", type=int, default=22399)
+    p.add_argument("-e", "--experiments", nargs="*",
+                   help="experiments to request trials for. Default: all")
+    p.add_argument("-c", "--concurrency", default="1,2,4,8,16,32,64",
+                   help="comma-separated concurrent participant counts to test")
+    p.add_argument("-n", "--participants", type=int, default=32,
+                   help="minimum number of participants simulated per level")
+    p.add_argument("--saturation_gain", type=float, default=0.1,
+                   help="minimum relative throughput gain from raising "
+                        "concurrency before the server counts as saturated")
+
+    main(p.parse_args())
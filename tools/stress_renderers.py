@@ -0,0 +1,91 @@
+"""
+Renders trial lists for every registered experiment concurrently, and checks
+that each rendered list is valid and independent of the others.
+
+Run this before raising the number of server threads in `psiturk/config.txt`.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent / "psiturk"))
+
+from materials_cache import MaterialsCache
+from renderers import TRIAL_RENDERERS, EXPERIMENT_MATERIALS
+
+
+def check_trials(renderer_cls, result):
+    """
+    Return a list of problems with a single rendered trial list.
+    """
+    problems = []
+    trials = result["trials"]
+
+    if len(trials) != renderer_cls.TOTAL_NUM_TRIALS:
+        problems.append(f"expected {renderer_cls.TOTAL_NUM_TRIALS} trials, "
+                        f"got {len(trials)}")
+
+    exp_ids = Counter(t["item_id"] for t in trials
+                      if t["condition_id"][0] != "filler")
+    filler_ids = Counter(t["item_id"] for t in trials
+                         if t["condition_id"][0] == "filler")
+    if len(exp_ids) != renderer_cls.NUM_EXP_TRIALS:
+        problems.append(f"expected {renderer_cls.NUM_EXP_TRIALS} distinct "
+                        f"experimental items, got {len(exp_ids)}")
+    if any(count > 1 for count in filler_ids.values()):
+        problems.append("repeated filler items")
+
+    return problems
+
+
+def main(args):
+    cache = MaterialsCache(args.materials_root)
+
+    failed = False
+    for experiment, renderer_cls in sorted(TRIAL_RENDERERS.items()):
+        materials_id = list(EXPERIMENT_MATERIALS[experiment])
+        try:
+            materials = tuple(cache.get(id) for id in materials_id)
+        except ValueError as exc:
+            print(f"{experiment}: skipping, {exc.args[0]}")
+            continue
+
+        def render(_):
+            renderer = renderer_cls(experiment)
+            return renderer.get_trials(materials, materials_id)
+
+        with ThreadPoolExecutor(args.threads) as executor:
+            results = list(executor.map(render, range(args.renders)))
+
+        problems = Counter()
+        for result in results:
+            problems.update(check_trials(renderer_cls, result))
+
+        # Independently seeded renders should essentially never coincide.
+        distinct = len(set(json.dumps(result, sort_keys=True)
+                           for result in results))
+        if distinct < len(results):
+            problems[f"only {distinct} distinct lists"] += 1
+
+        if problems:
+            failed = True
+            print(f"{experiment}: FAILED")
+            for problem, count in problems.items():
+                print(f"    {problem} ({count}x)")
+        else:
+            print(f"{experiment}: ok ({len(results)} lists)")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+
+    p.add_argument("-m", "--materials_root", default="/materials")
+    p.add_argument("-t", "--threads", type=int, default=16)
+    p.add_argument("-n", "--renders", type=int, default=200)
+
+    main(p.parse_args())